@@ -29,8 +29,10 @@
 """MRC file format: refer to
 http://www.msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
 
-Mrc class uses memory mapping (file size limit about 1GB (more or less)
+Mrc class uses memory mapping; files with more than MAX_MAP_BYTES of
+      pixel data are mapped a window of sections at a time (WindowedArray)
 Mrc2 class section wise file/array I/O
+MrcWriter class writes new files in large blocks, filling in header statistics
 """
 __author__  = "Sebastian Haase <haase@msg.ucsf.edu>"
 __copyright__ = "Copyright (c) 2005 The Regents of the University of California"
@@ -38,45 +40,68 @@ __license__ = "BSD license"
 
 import numpy as N
 
-def bindFile(fn, writable=0):
+## files with more pixel data (in bytes) than this are mapped a window of
+#  sections at a time instead of all at once (see WindowedArray)
+MAX_MAP_BYTES = 1 << 30
+
+## approximate size (in bytes) of one mapped window of sections
+WINDOW_BYTES = 64 << 20
+
+## maximal number of windows kept mapped at any one time
+MAX_WINDOWS = 16
+
+def bindFile(fn, writable=0, windowed=None):
     """open existing Mrc file
 
     returns memmaped array
     array has special 'Mrc' attribute 
+
+    if windowed is None: read-only files with more than MAX_MAP_BYTES of
+       pixel data are returned as a WindowedArray, which maps only the
+       sections that are being accessed
     """
 
     mode = 'r'
     if writable:
         mode = 'r+'
-    a = Mrc(fn, mode)
+    a = Mrc(fn, mode, windowed=windowed)
 
     return a.data_withMrc(fn)
 
 class Mrc:
-    def __init__(self, path, mode='r', extHdrSize=0, extHdrNints=0, extHdrNfloats=0):
+    def __init__(self, path, mode='r', extHdrSize=0, extHdrNints=0, extHdrNfloats=0,
+                 windowed=False):
         '''mode can be 'r' or 'r+'
+        windowed: map sections on demand (see WindowedArray)
+                  None means: only if read-only and bigger than MAX_MAP_BYTES
         '''
         import os
         self.path     = os.path.abspath(path)
         self.filename = os.path.basename(path)
+        self.mode     = mode
 
         if extHdrSize and extHdrSize % 1024:
             raise ValueError, "extended header size needs to be integer multiple of 1024"
 
-        self.m = N.memmap(path, mode=mode)
-        self.h = self.m[:1024]
-        
-        self.hdr = makeHdrArray(self.h)
-        
-        nzBeforeByteOrder = self.hdr.Num[0]
-        if nzBeforeByteOrder<0 or nzBeforeByteOrder>10000:
-            self.hdr._array.dtype = self.hdr._array.dtype.newbyteorder() 
-            self.isByteSwapped = True
-        else:    
-            self.isByteSwapped = False
-            
+        # map only the header to start with: we don't know yet whether
+        # the whole file should be mapped
+        self.m = N.memmap(path, mode=mode, shape=(1024,))
+        self._mapHeader()
         self.data_offset = 1024 + self.hdr.next
-        self.d = self.m[self.data_offset:]
+
+        fileSize = os.path.getsize(path)
+        if windowed is None:
+            windowed = mode == 'r' and fileSize - self.data_offset > MAX_MAP_BYTES
+        self.isWindowed = windowed
+
+        if self.isWindowed:
+            self.m = N.memmap(path, mode=mode, shape=(self.data_offset,))
+            self.d = None
+        else:
+            self.m = N.memmap(path, mode=mode)
+        self._mapHeader()
+        if not self.isWindowed:
+            self.d = self.m[self.data_offset:]
 
         self.e = self.m[1024:self.data_offset]
 
@@ -92,6 +117,18 @@ class Mrc:
             self.extHdrArray = None
 
 
+    def _mapHeader(self):
+        self.h = self.m[:1024]
+        
+        self.hdr = makeHdrArray(self.h)
+        
+        nzBeforeByteOrder = self.hdr.Num[0]
+        if nzBeforeByteOrder<0 or nzBeforeByteOrder>10000:
+            self.hdr._array.dtype = self.hdr._array.dtype.newbyteorder() 
+            self.isByteSwapped = True
+        else:    
+            self.isByteSwapped = False
+
     def insertExtHdr(self, numInts, numFloats, nz=-1):
         if numInts == numFloats == 0:
             raise "what ??"
@@ -145,6 +182,10 @@ class Mrc:
     def doDataMap(self):
         dtype = MrcMode2dtype( self.hdr.PixelType )
         shape = shapeFromHdr(self.hdr)
+
+        if self.isWindowed:
+            self.data = WindowedArray(SectionMapper(self, dtype), shape)
+            return
                 
         self.data = self.d.view()
         self.data.dtype = dtype
@@ -183,10 +224,11 @@ class Mrc:
 
     def looksOK(self, verbose=1):
         """do some basic checks like filesize, ..."""
+        import os
         shape = self.data.shape
         b = self.data.dtype.itemsize
         eb = N.prod( shape ) * b
-        ab = len(self.d)
+        ab = os.path.getsize(self.path) - self.data_offset
         secb = N.prod( shape[-2:] ) * b
 
         anSecs = ab / float(secb)
@@ -228,7 +270,8 @@ class Mrc:
                 self.Mrc = getattr(obj, 'Mrc', None)
 
         data = self.data
-        data.__class__ = ndarray_inMrcFile
+        if not self.isWindowed:
+            data.__class__ = ndarray_inMrcFile
         ddd = weakref.proxy( data )
         self.data = ddd
         data.Mrc = self
@@ -237,6 +280,8 @@ class Mrc:
         
 
     def close(self):
+        if self.isWindowed:
+            self.data.mapper.close()
         self.m.close()
 
 
@@ -246,6 +291,462 @@ class Mrc:
 ###########################################################################
 ###########################################################################
 
+class SectionMapper:
+    '''
+    maps the sections (2D images) of an Mrc file into memory on demand,
+    a window of consecutive sections at a time
+
+    at most MAX_WINDOWS windows (of about WINDOW_BYTES each) are kept mapped;
+    the least recently used window is unmapped to make room for a new one,
+    so the address space used is bounded no matter how big the file is
+    '''
+    def __init__(self, mrc, dtype, windowBytes=None, maxWindows=None):
+        import os, threading
+        from collections import OrderedDict
+        if windowBytes is None:
+            windowBytes = WINDOW_BYTES
+        if maxWindows is None:
+            maxWindows = MAX_WINDOWS
+
+        nx, ny = int(mrc.hdr.Num[0]), int(mrc.hdr.Num[1])
+        self.path = mrc.path
+        self.mode = mrc.mode
+        self.offset = long(mrc.data_offset)
+        self.dtype = N.dtype(dtype)
+        if mrc.isByteSwapped:
+            self.dtype = self.dtype.newbyteorder()
+        self.secShape = (ny, nx)
+        self.secByteSize = long(ny * nx * self.dtype.itemsize)
+        # sections actually present in the file (it could be truncated)
+        fileBytes = os.path.getsize(self.path) - self.offset
+        self.nSecs = int(fileBytes // self.secByteSize)
+        self.secsPerWindow = int(max(1, windowBytes // self.secByteSize))
+        self.maxWindows = max(1, maxWindows)
+
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _window(self, w):
+        '''return memmap of window w, mapping it (and unmapping the least
+        recently used window) if necessary
+        '''
+        with self._lock:
+            try:
+                win = self._windows.pop(w)
+            except KeyError:
+                first = w * self.secsPerWindow
+                n = min(self.secsPerWindow, self.nSecs - first)
+                win = N.memmap(self.path, dtype=self.dtype, mode=self.mode,
+                               offset=self.offset + first * self.secByteSize,
+                               shape=(n,) + self.secShape)
+                while len(self._windows) >= self.maxWindows:
+                    self._windows.popitem(last=False)
+            self._windows[w] = win
+            return win
+
+    def section(self, i):
+        '''return (memmaped) section i
+        the returned array keeps its window mapped as long as it is alive
+        '''
+        if i < 0 or i >= self.nSecs:
+            raise IndexError, "section %d out of range (%d sections)" % (i, self.nSecs)
+        w, j = divmod(i, self.secsPerWindow)
+        return self._window(w)[j]
+
+    def close(self):
+        with self._lock:
+            self._windows.clear()
+
+
+class WindowedArray(object):
+    '''
+    read-only array-like view of the sections of an Mrc file
+    that maps only the sections it needs (using a SectionMapper)
+
+    supports:  shape, ndim, size, dtype, nbytes, len()
+               indexing with integers, slices and Ellipsis (returns ndarray)
+               transpose() and reshape() that only adds/removes length-1 axes
+                  (both return another WindowedArray)
+               lazyIndex(i, j, ...) - self[i, j, ...] for integers, as
+                  another WindowedArray (reads nothing)
+               min(), max(), mean() - optionally along one axis
+               N.asarray(a) (reads everything !)
+
+    the last two axes are always y,x (in some order); all other axes
+    select sections
+    '''
+    def __init__(self, mapper, shape, _axes=None, _fixed=None):
+        '''shape is the "smart" shape of the file, as from shapeFromHdr'''
+        self.mapper = mapper
+        # shape of the section-selecting axes + (ny,nx), as stored in file
+        self._baseShape = tuple(int(n) for n in shape)
+        nBase = len(self._baseShape)
+        # base axis index for each of our axes (None for inserted axes)
+        if _axes is None:
+            _axes = range(nBase)
+        self._axes = list(_axes)
+        # base axes fixed to one index (by integer indexing)
+        if _fixed is None:
+            _fixed = {}
+        self._fixed = dict(_fixed)
+
+        nSecs = N.prod(self._baseShape[:-2])
+        if nSecs > mapper.nSecs:  # file contains INCOMPLETE sections
+            print "** WARNING **: file truncated - shape from header:", shape,"expected to get",nSecs,"sections but got",mapper.nSecs
+            s0 = mapper.nSecs // N.prod(self._baseShape[1:-2])
+            self._baseShape = (s0,) + self._baseShape[1:]
+
+    shape = property(lambda self: tuple([(self._baseShape[a] if a is not None else 1)
+                                         for a in self._axes]))
+    ndim = property(lambda self: len(self._axes))
+    size = property(lambda self: int(N.prod(self.shape)))
+    dtype = property(lambda self: self.mapper.dtype)
+    itemsize = property(lambda self: self.mapper.dtype.itemsize)
+    nbytes = property(lambda self: self.size * self.itemsize)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<WindowedArray %s %s of %s>" % (self.shape, self.dtype, self.mapper.path)
+
+    def __array__(self, dtype=None):
+        a = self[...]
+        if dtype is not None:
+            a = a.astype(dtype)
+        return a
+
+    def _new(self, axes, fixed):
+        a = WindowedArray.__new__(WindowedArray)
+        a.mapper = self.mapper
+        a._baseShape = self._baseShape
+        a._axes = list(axes)
+        a._fixed = dict(fixed)
+        return a
+
+    def transpose(self, *axes):
+        if len(axes) == 1 and not isinstance(axes[0], (int, long)):
+            axes = axes[0]
+        if not axes:
+            axes = range(self.ndim)[::-1]
+        if sorted(axes) != range(self.ndim):
+            raise ValueError, "axes don't match array"
+        return self._new([self._axes[i] for i in axes], self._fixed)
+
+    def reshape(self, *shape):
+        '''only inserting or removing axes of length 1 is supported'''
+        if len(shape) == 1 and not isinstance(shape[0], (int, long)):
+            shape = shape[0]
+        shape = tuple(shape)
+        axes = []
+        old = [a for a in self._axes if a is not None]
+        for n in shape:
+            if old and self._baseShape[old[0]] == n:
+                axes.append(old.pop(0))
+            elif n == 1:
+                axes.append(None)
+            else:
+                raise ValueError, "WindowedArray can only add/remove length-1 axes"
+        for a in old:
+            if self._baseShape[a] != 1:
+                raise ValueError, "WindowedArray can only add/remove length-1 axes"
+        fixed = dict(self._fixed)
+        for a in old:
+            fixed[a] = 0
+        return self._new(axes, fixed)
+
+    def _normalizeKey(self, key):
+        if not isinstance(key, (tuple, list)):
+            key = (key,)
+        key = list(key)
+        # expand Ellipsis; like old numpy, any further Ellipsis is taken
+        # to be a single ':'
+        if Ellipsis in key:
+            first = key.index(Ellipsis)
+            key = key[:first + 1] + [k if k is not Ellipsis else slice(None)
+                                     for k in key[first + 1:]]
+        nExplicit = len([k for k in key if k is not Ellipsis])
+        if nExplicit > self.ndim:
+            raise IndexError, "too many indices"
+        full = []
+        for k in key:
+            if k is Ellipsis:
+                full.extend([slice(None)] * (self.ndim - nExplicit))
+            else:
+                full.append(k)
+        full.extend([slice(None)] * (self.ndim - len(full)))
+        for i, k in enumerate(full):
+            if isinstance(k, (int, long, N.integer)):
+                n = self.shape[i]
+                k = int(k)
+                if k < -n or k >= n:
+                    raise IndexError, "index %d out of bounds for axis %d with size %d" % (k, i, n)
+                full[i] = k % n
+            elif not isinstance(k, slice):
+                raise IndexError, "WindowedArray only supports integers, slices and Ellipsis"
+        return full
+
+    def _subarray(self, i):
+        '''lazy equivalent of self[i] for an integer i'''
+        a = self._axes[0]
+        fixed = dict(self._fixed)
+        if a is not None:
+            fixed[a] = i % self._baseShape[a]
+        return self._new(self._axes[1:], fixed)
+
+    def lazyIndex(self, *indices):
+        '''lazy equivalent of self[i, j, ...] for integers i, j, ...'''
+        a = self
+        for i in indices:
+            a = a._subarray(i)
+        return a
+
+    def __getitem__(self, key):
+        import itertools
+        key = self._normalizeKey(key)
+        nBase = len(self._baseShape)
+        # what to take along each base axis
+        baseKey = [None] * nBase
+        for a, i in self._fixed.items():
+            baseKey[a] = i
+        for a, k in zip(self._axes, key):
+            if a is not None:
+                baseKey[a] = k
+        for a in range(nBase):
+            if baseKey[a] is None:
+                baseKey[a] = slice(None)
+
+        secKeys = []
+        for a in range(nBase - 2):
+            k = baseKey[a]
+            if isinstance(k, slice):
+                secKeys.append(range(*k.indices(self._baseShape[a])))
+            else:
+                secKeys.append([k])
+        yxKey = tuple(baseKey[-2:])
+
+        resShape = [len(k) for k in secKeys]
+        yx = N.empty(self.mapper.secShape, dtype=bool)[yxKey].shape
+        result = N.empty(resShape + list(yx), self.dtype)
+        secShape = self._baseShape[:-2]
+        for pos in itertools.product(*[range(n) for n in resShape]):
+            idx = tuple(secKeys[a][p] for a, p in enumerate(pos))
+            i = int(N.ravel_multi_index(idx, secShape)) if idx else 0
+            result[pos] = self.mapper.section(i)[yxKey]
+
+        # drop the integer-indexed section axes, then reorder from base
+        # axis order to ours and add the inserted length-1 axes
+        result = result.reshape([len(k) for a, k in enumerate(secKeys)
+                                 if isinstance(baseKey[a], slice)] + list(yx))
+        baseOrder = [a for a in range(nBase) if isinstance(baseKey[a], slice)]
+        order = [a for a, k in zip(self._axes, key)
+                 if a is not None and isinstance(k, slice)]
+        result = result.transpose([baseOrder.index(a) for a in order])
+        finalShape = []
+        j = 0
+        for a, k in zip(self._axes, key):
+            if not isinstance(k, slice):
+                continue
+            if a is None:
+                finalShape.append(len(range(*k.indices(1))))
+            else:
+                finalShape.append(result.shape[j])
+                j += 1
+        if 0 in finalShape:
+            return N.empty(finalShape, self.dtype)
+        return result.reshape(finalShape)
+
+    def _reduce(self, name, axis=None, dtype=None):
+        '''apply reduction 'name' one sub-array of axis 0 at a time'''
+        if self.ndim <= 2 or self.nbytes <= self.mapper.secByteSize * self.mapper.secsPerWindow:
+            a = self[...]
+            if name == 'mean':
+                return a.mean(axis=axis, dtype=dtype)
+            return getattr(a, name)(axis=axis)
+        if axis is not None and axis < 0:
+            axis += self.ndim
+        n = self.shape[0]
+        if axis is None:
+            parts = N.array([self._subarray(i)._reduce(name, None, dtype) for i in range(n)])
+            if name == 'mean':
+                return parts.mean()
+            return getattr(parts, name)()
+        if axis == 0:
+            result = N.array(self._subarray(0)[...], dtype=N.float64 if name == 'mean' else None)
+            for i in range(1, n):
+                sub = self._subarray(i)[...]
+                if name == 'mean':
+                    result += sub
+                elif name == 'max':
+                    N.maximum(result, sub, result)
+                else:
+                    N.minimum(result, sub, result)
+            if name == 'mean':
+                result /= n
+                if dtype is None:
+                    dtype = N.float64
+                result = result.astype(dtype)
+            return result
+        return N.array([self._subarray(i)._reduce(name, axis - 1, dtype) for i in range(n)])
+
+    def max(self, axis=None):
+        return self._reduce('max', axis)
+
+    def min(self, axis=None):
+        return self._reduce('min', axis)
+
+    def mean(self, axis=None, dtype=None):
+        return self._reduce('mean', axis, dtype)
+
+
+
+###########################################################################
+###########################################################################
+###########################################################################
+###########################################################################
+
+class MrcWriter:
+    '''
+    writes a new Mrc file whose header is already set up, sections in
+    file order, for when the data doesn't all exist in memory at once
+
+    the file is preallocated to its full size when it is created; data is
+    written in large contiguous blocks (e.g. a whole Z stack at a time), or
+    can be written in place through a writable memmap of the next sections
+    (mapSections)
+    min/max/mean of each wavelength are accumulated as the data goes past
+    and put into the header (mmm1, mm2 .. mm5) when the writer is closed
+
+    usage:
+        w = MrcWriter(path, hdr)
+        for stack in stacks:
+            w.writeSections(stack)
+        w.close()
+    '''
+    def __init__(self, path, hdr):
+        self.path = path
+        self.hdr = hdr
+        self.dtype = N.dtype(MrcMode2dtype(hdr.PixelType))
+        nx, ny, nSecs = [int(n) for n in hdr.Num]
+        self.secShape = (ny, nx)
+        self.secByteSize = long(ny * nx * self.dtype.itemsize)
+        self.nSecs = nSecs
+        self.dataOffset = long(1024 + hdr.next)
+        # index of the next section to write
+        self.nextSec = 0
+
+        # sizes of the section-selecting axes, slowest first, and which
+        # of them (if any) is the wavelength axis
+        order = axisOrderStr(hdr)[:-2]
+        nw, nt = int(hdr.NumWaves), int(hdr.NumTimes)
+        sizes = {'w': nw, 't': nt, 'z': nSecs // (nw * nt)}
+        self._waveStride = 1
+        for letter in order[order.find('w') + 1:]:
+            self._waveStride *= sizes[letter]
+        self._numWaves = nw
+        # per wavelength: min, max, sum, count
+        self._stats = [[None, None, 0., 0] for w in range(nw)]
+        # mapped sections not yet accounted for in self._stats
+        self._mapped = None
+
+        self._f = file(path, 'w+b')
+        self._f.truncate(self.dataOffset + nSecs * self.secByteSize)
+        self._f.seek(self.dataOffset)
+
+    def writeSections(self, a):
+        '''write the 2D section or 3D stack of sections a at the
+        current position (converting it to the file's pixel type)
+        '''
+        self._flushMapped()
+        a = N.ascontiguousarray(a, dtype=self.dtype)
+        if a.ndim == 2:
+            a = a.reshape((1,) + a.shape)
+        self._checkRoom(len(a))
+        self._f.seek(self.dataOffset + self.nextSec * self.secByteSize)
+        a.tofile(self._f)
+        self._accumulate(a, self.nextSec)
+        self.nextSec += len(a)
+
+    def mapSections(self, n):
+        '''return a writable memmap of the next n sections, to be filled
+        in place; the data is accounted for in the header at the next
+        write or at close, so it must be complete by then
+        '''
+        self._flushMapped()
+        self._checkRoom(n)
+        self._f.flush()
+        a = N.memmap(self._f, dtype=self.dtype, mode='r+',
+                     offset=self.dataOffset + self.nextSec * self.secByteSize,
+                     shape=(n,) + self.secShape)
+        self._mapped = (a, self.nextSec)
+        self.nextSec += n
+        return a
+
+    def close(self):
+        '''account for any mapped sections, then write the header with
+        the min/max/mean of the data, and close the file
+        '''
+        self._flushMapped()
+        stats = []
+        for minVal, maxVal, total, count in self._stats:
+            if count:
+                stats.append((minVal, maxVal, total / count))
+            else:
+                stats.append((0, 0, 0))
+        self.hdr.mmm1 = stats[0]
+        for w, field in enumerate(['mm2', 'mm3', 'mm4', 'mm5']):
+            if w + 1 < len(stats):
+                setattr(self.hdr, field, stats[w + 1][:2])
+        self._f.seek(0)
+        self.hdr._array.tofile(self._f)
+        self._f.close()
+
+    def abort(self):
+        '''close the file without writing the header, and delete it,
+        for when writing it has failed part way
+        '''
+        import os
+        # drop any mapped sections first; a file can't be deleted while
+        # it is mapped on some platforms
+        self._mapped = None
+        if not self._f.closed:
+            self._f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _checkRoom(self, n):
+        if self.nextSec + n > self.nSecs:
+            raise ValueError, "writing %d sections at section %d of %d" % (n, self.nextSec, self.nSecs)
+
+    def _flushMapped(self):
+        if self._mapped is not None:
+            a, first = self._mapped
+            self._mapped = None
+            a.flush()
+            self._accumulate(a, first)
+            del a
+
+    def _accumulate(self, a, first):
+        '''add sections a, starting at section index first, to the
+        per-wavelength statistics
+        '''
+        i = 0
+        while i < len(a):
+            # run of consecutive sections in the same wavelength
+            w = ((first + i) // self._waveStride) % self._numWaves
+            n = min(len(a) - i, self._waveStride - (first + i) % self._waveStride)
+            run = a[i:i + n]
+            stats = self._stats[w]
+            minVal, maxVal = run.min(), run.max()
+            if stats[3] == 0 or minVal < stats[0]:
+                stats[0] = minVal
+            if stats[3] == 0 or maxVal > stats[1]:
+                stats[1] = maxVal
+            stats[2] += run.sum(dtype=N.float64)
+            stats[3] += run.size
+            i += n
+
+
 def open(path, mode='r'):
     return Mrc2(path, mode)
 
@@ -28,13 +28,21 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
+import multiprocessing
 import numpy
+import Queue
 import scipy
+import scipy.ndimage
 import scipy.optimize
+import sys
 import threading
 import time
+import traceback
+import arraycache
 import datadoc
 import editor
+import pyramid
 
 
 ## Step size multipliers to convince simplex to take differently-sized steps
@@ -50,6 +58,162 @@ Z_MULTIPLIER = 20000
 # much, we'll run it again.
 MIN_COST_CHANGE = .1 ** 4
 
+## Seconds AutoAligner waits for progress from its worker processes before 
+# checking that they are still alive.
+WORKER_POLL_INTERVAL = 1
+
+## Maximum number of bytes of reference spectra to keep for 
+# SimplexAlign.getOffset, so that each reference plane is only transformed 
+# once however many channels and timepoints are aligned against it.
+SPECTRUM_CACHE_BYTES = 32 * 1024 * 1024
+
+## Factors, coarsest first, by which SimplexAlign downsamples the data to 
+# align it at lower resolutions before aligning it at full resolution. Each
+# level starts from the result of the one before, so the expensive 
+# full-resolution search starts close to the answer.
+PYRAMID_FACTORS = [4, 2]
+
+## Scale of Simplex's initial steps at full resolution, once SimplexAlign 
+# has aligned downsampled data: the search starts close to the answer, so 
+# it only needs to look nearby, and a single pass is enough.
+REFINE_STEP_SCALE = .25
+
+## Step size multipliers for polishing the result of FourierAlign, which is
+# already close: initial steps of .1 pixel, .1 degree, and .00025 zoom.
+POLISH_STEP_MULTIPLIER = numpy.array([400, 400, 400, 1])
+
+## Maximum number of Simplex iterations FourierAlign polishes its result with.
+POLISH_ITERATIONS = 100
+
+## Standard deviation, in pixels, of the Gaussian that correlation peaks 
+# are smoothed with before locating them; broader peaks are located to 
+# sub-pixel accuracy more reliably.
+PEAK_WIDTH = 2
+
+## Number of times FourierAlign estimates rotation and zoom, each time 
+# from the data transformed by the previous estimate. The estimates are 
+# biased towards no change, but the bias shrinks with the change left.
+FOURIER_MELLIN_ITERATIONS = 3
+
+## Smallest spatial frequency, in cycles across the image, that 
+# FourierAlign considers when finding rotation and zoom; lower frequencies 
+# say little about either.
+MIN_LOG_POLAR_FREQUENCY = 2
+
+
+## Transform a 2D array as DataDoc.transformArray transforms each XY slice
+# of a volume, so that channels can be aligned without going back to the
+# DataDoc for every trial transformation.
+def warpPlane(plane, dx, dy, angle, zoom, order = 1, cval = 0):
+    invertedTransform, offset = datadoc.getYXTransform(plane.shape, 
+            dx, dy, angle, zoom)
+    return scipy.ndimage.affine_transform(plane, invertedTransform, offset,
+            order = order, cval = cval)
+
+
+## Return a 2D Hann window of the given shape, to taper data to zero at its
+# edges so they don't dominate its Fourier transform.
+def getWindow(shape):
+    return numpy.outer(numpy.hanning(shape[0]), numpy.hanning(shape[1]))
+
+
+## Return the position of the maximum of a 2D array, refined to sub-pixel 
+# accuracy by fitting a parabola through it and its neighbours along each 
+# axis. The array is treated as periodic, as correlations computed with 
+# Fourier transforms are.
+def getPeak(data):
+    peak = numpy.unravel_index(numpy.argmax(data), data.shape)
+    result = []
+    for axis, index in enumerate(peak):
+        values = []
+        for delta in (-1, 0, 1):
+            position = list(peak)
+            position[axis] = (index + delta) % data.shape[axis]
+            values.append(data[tuple(position)])
+        low, middle, high = values
+        curvature = low - 2 * middle + high
+        offset = 0
+        if curvature:
+            offset = .5 * (low - high) / curvature
+        result.append(index + offset)
+    return numpy.array(result)
+
+
+## Return the YX shift that best maps b onto a, i.e. such that 
+# a[p] ~= b[p - shift], by phase correlation. Shifts wrap around, so they 
+# are between minus and plus half the size of the arrays.
+def phaseCorrelate(a, b):
+    product = numpy.fft.rfft2(a) * numpy.fft.rfft2(b).conj()
+    # Keep only the phase, which holds the shift, and smooth the peak that 
+    # gives by PEAK_WIDTH.
+    product /= numpy.maximum(abs(product), 1e-12)
+    yFreqs = numpy.fft.fftfreq(a.shape[0]).reshape(-1, 1)
+    xFreqs = numpy.fft.rfftfreq(a.shape[1]).reshape(1, -1)
+    product *= numpy.exp(-2 * (numpy.pi * PEAK_WIDTH) ** 2 * 
+            (yFreqs ** 2 + xFreqs ** 2))
+    correlation = numpy.fft.irfft2(product, a.shape)
+    shape = numpy.array(a.shape)
+    return (getPeak(correlation) + shape / 2.0) % shape - shape / 2.0
+
+
+## Cache of reference spectra for getReferenceSpectrum.
+referenceSpectra = arraycache.ArrayCache(SPECTRUM_CACHE_BYTES)
+
+
+## Return the real Fourier transform of a 2D array with its mean removed, 
+# tapered by getWindow if shouldApodize. Spectra are cached by the array's 
+# contents, so a reference plane shared by several channels, or the same 
+# from one timepoint to the next, is only transformed once.
+def getReferenceSpectrum(data, shouldApodize):
+    data = numpy.ascontiguousarray(data)
+    key = (hashlib.sha1(data).hexdigest(), data.shape, data.dtype.str, 
+            shouldApodize)
+    spectrum = referenceSpectra.get(key)
+    if spectrum is None:
+        spectrum = numpy.fft.rfft2(getApodized(data, shouldApodize))
+        referenceSpectra.add(key, spectrum)
+    return spectrum
+
+
+## Return a 2D array less its mean, tapered by getWindow if shouldApodize. 
+# The mean is removed first so that the window's own shape doesn't 
+# correlate with itself and pull offsets towards zero.
+def getApodized(data, shouldApodize):
+    result = data - data.mean()
+    if shouldApodize:
+        result *= getWindow(data.shape)
+    return result
+
+
+## Return the magnitude of the Fourier transform of a 2D array resampled 
+# onto a log-polar grid: rotating the array shifts the result along its 
+# angle axis (the second), and zooming it shifts the result along its log 
+# radius axis. The magnitude doesn't depend on where things are in the 
+# array, so the rotation and zoom between two arrays can be found with 
+# phaseCorrelate regardless of any translation between them.
+# \return The resampled spectrum, with angles covering 180 degrees (the 
+#         spectrum of real data is symmetric), and the step in log 
+#         frequency between its rows.
+def getLogPolarSpectrum(data, numAngles, numRadii):
+    shape = numpy.array(data.shape)
+    spectrum = abs(numpy.fft.fftshift(numpy.fft.fft2(data * getWindow(shape))))
+    # Emphasize high frequencies, which locate edges precisely, over the 
+    # low frequencies that dominate the spectra of most images.
+    yFreqs = numpy.fft.fftshift(numpy.fft.fftfreq(shape[0])).reshape(-1, 1)
+    xFreqs = numpy.fft.fftshift(numpy.fft.fftfreq(shape[1])).reshape(1, -1)
+    highPass = numpy.cos(numpy.pi * yFreqs) * numpy.cos(numpy.pi * xFreqs)
+    spectrum *= (1 - highPass) * (2 - highPass)
+    # Frequencies in cycles per pixel, from the lowest we consider up to 
+    # the Nyquist frequency.
+    minRadius = float(MIN_LOG_POLAR_FREQUENCY) / shape.min()
+    radiusStep = numpy.log(.5 / minRadius) / (numRadii - 1)
+    radii = minRadius * numpy.exp(radiusStep * numpy.arange(numRadii))
+    angles = numpy.arange(numAngles) * numpy.pi / numAngles
+    center = shape // 2
+    coords = [center[0] + numpy.outer(radii, numpy.sin(angles)) * shape[0],
+              center[1] + numpy.outer(radii, numpy.cos(angles)) * shape[1]]
+    return scipy.ndimage.map_coordinates(spectrum, coords, order = 1), radiusStep
+
 
 class AutoAligner():
     """
@@ -58,38 +222,120 @@ class AutoAligner():
     SimplexAlign calls back into the GUI / AutoAligner, so locking required.
     """
 
-    def __init__(self, dataDoc, refChannel):
+    def __init__(self, dataDoc, refChannel, method = 'simplex',
+                 useProcesses = False):
         self.dataDoc = dataDoc
         self.refChannel = refChannel
+        # name of the alignment method to use, from ALIGN_METHODS
+        self.method = method
+        # if true, align each channel in its own process, not thread
+        self.useProcesses = useProcesses
         self.alignerLock = threading.Lock()
 
     def run(self):
         """
-        Use Simplex method to auto-align channels to the reference,
-        updating dataDoc.alignParams with final alignment parameters.
+        Use Simplex method (or the chosen method) to auto-align channels
+        to the reference, updating dataDoc.alignParams with final
+        alignment parameters.
         """
         channelsToAlign = range(self.dataDoc.numWavelengths)
         del channelsToAlign[self.refChannel]
         self.alignedChannels = dict([(i, False) for i in channelsToAlign])
         targetCoords = self.dataDoc.getSliceCoords((1, 2))
         referenceData = self.getFilteredData(self.refChannel)
+        if self.useProcesses:
+            self.runInProcesses(referenceData, channelsToAlign)
+            return
         aligners = []
         for i in channelsToAlign:
             if i == self.refChannel:
                 continue
-            guess = [0.0, 0.0, 0.0, 0.0, 1.0]  # X, Y, Z, Rot, Zoom
-            aligner = SimplexAlign(self, referenceData, i, guess,
-                    shouldAdjustGuess = True)
-            aligners.append(aligner)
+            aligners.append(self.startAligner(referenceData, i))
         for aligner in aligners:
             aligner.join()
 
+    def startAligner(self, referenceData, channel):
+        """
+        Start and return an aligner thread for the channel.
+        """
+        guess = [0.0, 0.0, 0.0, 0.0, 1.0]  # X, Y, Z, Rot, Zoom
+        return ALIGN_METHODS[self.method](self, referenceData, channel,
+                guess, shouldAdjustGuess = True)
+
+    def runInProcesses(self, referenceData, channels):
+        """
+        Align each channel in its own worker process, so the channels
+        don't contend for one interpreter. The reference data is shared
+        with the workers through shared memory; their progress and
+        results come back over a queue and are handled here as if from
+        aligner threads.
+        """
+        sharedReference = multiprocessing.RawArray('d', referenceData.size)
+        numpy.frombuffer(sharedReference)[:] = referenceData.ravel()
+        queue = multiprocessing.Queue()
+        # Workers flush what they inherit of our output buffer on exit.
+        sys.stdout.flush()
+        doc = self.dataDoc
+        processes = {}
+        for channel in channels:
+            process = multiprocessing.Process(target = alignInProcess,
+                    args = (doc.filePath, doc.alignParams, doc.cropMin,
+                            doc.cropMax, doc.curViewIndex, doc.averages,
+                            self.refChannel, channel, self.method,
+                            sharedReference, referenceData.shape, queue))
+            process.daemon = True
+            process.start()
+            processes[channel] = process
+        try:
+            while not all(self.alignedChannels.values()):
+                try:
+                    message = queue.get(timeout = WORKER_POLL_INTERVAL)
+                except Queue.Empty:
+                    # A worker that exits flushes its messages first, so
+                    # if there are none, any that exited without
+                    # finishing have failed.
+                    for channel, process in processes.iteritems():
+                        if (not process.is_alive() and
+                                not self.alignedChannels[channel]):
+                            raise RuntimeError("Aligning channel %d failed" %
+                                    channel)
+                    continue
+                self.handleWorkerMessage(message)
+        finally:
+            for process in processes.itervalues():
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+    def handleWorkerMessage(self, message):
+        """
+        Act on a (kind, channel, ...) message from a worker process.
+        """
+        kind, channel = message[:2]
+        if kind == 'cost':
+            self.updateAutoAlign(message[2], message[3], channel)
+        elif kind == '3D':
+            self.alignSwitchTo3D(channel)
+        elif kind == 'done':
+            self.finishAutoAligning(message[2], channel)
+        else:
+            raise RuntimeError("Aligning channel %d failed:\n%s" %
+                    (channel, message[2]))
+
     def getFilteredData(self, channel, perpendicularAxes = (1, 2)):
         """
         Return data thresholded at mid-point between mean/max and normalized 0-1.
         """
         targetCoords = self.dataDoc.getSliceCoords(perpendicularAxes)
-        baseData = self.dataDoc.takeSlice(targetCoords).astype(numpy.float)[channel]
+        return self.filterSlice(channel,
+                self.dataDoc.takeSlice(targetCoords)[channel])
+
+    def filterSlice(self, channel, data):
+        """
+        Filter data from the channel as getFilteredData does, returning a
+        new array.
+        """
+        baseData = data.astype(numpy.float)
         minCut = (baseData.max() + baseData.mean()) / 2
         maxCut = baseData.max()
         baseData[numpy.where(baseData < minCut)] = minCut
@@ -97,14 +343,18 @@ class AutoAligner():
         return (baseData - minCut) / (maxCut - minCut)
 
 
-    def getFullVolume(self, channel, worker):
+    def getFullVolume(self, channel, worker, params):
         """
-        Return 3D array for channel + reference channel and pass to worker.
+        Return 3D array for channel + reference channel and pass to worker,
+        aligning the channel with the given parameters.
         """
+        alignParams = self.dataDoc.alignParams.copy()
+        alignParams[channel] = params
         with self.alignerLock:
             result = self.dataDoc.alignAndCrop(
                     wavelengths = [self.refChannel, channel],
-                    timepoints = [self.dataDoc.curViewIndex[1]])
+                    timepoints = [self.dataDoc.curViewIndex[1]],
+                    alignParams = alignParams)
             # Take the first timepoint.
             worker.setVolumes(result[0][0], result[1][0])
 
@@ -139,6 +389,88 @@ class AutoAligner():
 
 
 
+class ProcessAligner(AutoAligner):
+    """
+    Stand-in for AutoAligner in a worker process: aligns a single
+    channel, and sends progress and results to the AutoAligner in the
+    parent process over a queue.
+    """
+
+
+    def __init__(self, dataDoc, refChannel, method, queue):
+        AutoAligner.__init__(self, dataDoc, refChannel, method)
+        self.queue = queue
+
+    def updateAutoAlign(self, startCost, currentCost, channel):
+        self.queue.put(('cost', channel, startCost, currentCost))
+
+    def alignSwitchTo3D(self, channel):
+        self.queue.put(('3D', channel))
+
+    def finishAutoAligning(self, result, channel):
+        self.queue.put(('done', channel, tuple(result)))
+
+
+def alignInProcess(filePath, alignParams, cropMin, cropMax, viewIndex,
+                   averages, refChannel, channel, method, sharedReference,
+                   referenceShape, queue):
+    """
+    Worker process for AutoAligner.runInProcesses: open the file, copy
+    over the parent's view and parameters, and align one channel.
+    """
+    try:
+        dataDoc = datadoc.DataDoc(filePath, refineStats = False)
+        dataDoc.alignParams = alignParams
+        dataDoc.cropMin = cropMin
+        dataDoc.cropMax = cropMax
+        dataDoc.curViewIndex = viewIndex
+        # Fill in slices as the parent does.
+        dataDoc.averages[:] = averages
+        referenceData = numpy.frombuffer(sharedReference).reshape(
+                referenceShape)
+        aligner = ProcessAligner(dataDoc, refChannel, method, queue)
+        aligner.startAligner(referenceData, channel).join()
+    except Exception:
+        queue.put(('error', channel, traceback.format_exc()))
+
+
+## Compute SimplexAlign's cost for trial 2D transformations of one channel:
+# 1 minus the correlation coefficient between the transformed moving data 
+# and the reference data. The moving data is filtered once, untransformed,
+# and each trial warps it into a reusable buffer, rather than taking and 
+# filtering a transformed slice through every channel from the DataDoc.
+class CostEvaluator:
+    ## \param referenceData Filtered data that is held fixed.
+    # \param movingData Filtered data to transform, of the same shape.
+    # \param fillValue Value for transformed data that comes from outside
+    #        the moving data.
+    def __init__(self, referenceData, movingData, fillValue = 0):
+        self.movingData = movingData
+        self.fillValue = fillValue
+        ## The reference data less its mean, flattened, and its sum of 
+        # squares, which don't change from one trial to the next.
+        self.reference = (referenceData - referenceData.mean()).ravel()
+        self.referenceSquared = numpy.dot(self.reference, self.reference)
+        ## Buffer for the transformed moving data.
+        self.transformed = numpy.empty(movingData.shape, numpy.float64)
+
+
+    ## Return the cost for the given transformation of the moving data.
+    def getCost(self, dx, dy, angle, zoom):
+        invertedTransform, offset = datadoc.getYXTransform(
+                self.movingData.shape, dx, dy, angle, zoom)
+        scipy.ndimage.affine_transform(self.movingData, invertedTransform,
+                offset, output = self.transformed, order = 1,
+                cval = self.fillValue)
+        transformed = self.transformed.ravel()
+        transformed -= transformed.mean()
+        numerator = numpy.dot(transformed, self.reference)
+        transformedSquared = numpy.dot(transformed, transformed)
+        return 1 - numerator / numpy.sqrt(transformedSquared * 
+                self.referenceSquared)
+
+
+
 ## Use the Simplex algorithm as implemented in SciPy to find the transformation
 # (as an XY translation, a rotation about Z, and a zoom factor) from the first
 # matrix to the second matrix. Both matrices are 2D here; Z translation is
@@ -152,8 +484,10 @@ class SimplexAlign(threading.Thread):
     # \param guess Initial alignment parameters (dx, dy, rotation, zoom)
     # \param shouldAdjustGuess If true, use cross correlation to adjust the
     #        guess in an attempt to improve it.
+    # \param shouldUsePyramid If true, align downsampled data first; see 
+    #        PYRAMID_FACTORS.
     def __init__(self, parent, referenceData, index, guess,
-                 shouldAdjustGuess = False):
+                 shouldAdjustGuess = False, shouldUsePyramid = True):
         threading.Thread.__init__(self)
         ## Our parent needs to implement certain methods so we can communicate
         # with it.
@@ -181,6 +515,15 @@ class SimplexAlign(threading.Thread):
 
         self.startingCost = None
         self.currentCost = None
+        ## Multipliers to convert Simplex's parameters into transformations.
+        self.stepMultiplier = STEP_MULTIPLIER
+        ## Whether to align downsampled data before full-resolution data.
+        self.shouldUsePyramid = shouldUsePyramid
+        ## While aligning downsampled data, the downsampling factor and a
+        # CostEvaluator for the downsampled data.
+        self.pyramidLevel = None
+        ## CostEvaluator for our channel; set up when we start running.
+        self.evaluator = None
 
         ## This lock is used whenever we need to interact with our parent to
         # change data (i.e. at the transition from 2D to 3D alignment).
@@ -198,30 +541,116 @@ class SimplexAlign(threading.Thread):
     # holding the 2D transformation parameters fixed (on the assumption that
     # Z alignment is independent of 2D alignment).
     def run(self):
+        self.evaluator = self.makeEvaluator()
+        transform = self.align2D()
+        self.alignZ(transform)
+        transform = (transform[0], transform[1], self.zTransform,
+                     transform[2], transform[3])
+        self.parent.finishAutoAligning(transform, self.index)
+
+
+    ## Make a CostEvaluator for our channel, taking the moving data from our
+    # parent without any 2D transformation, and filtering it as our parent
+    # filters its data. The fill value for the data is filtered along with
+    # it so that it's mapped the same way. The parent's alignment parameters
+    # are left alone, since they're shared with whatever else is using it.
+    def makeEvaluator(self):
+        dataDoc = self.parent.dataDoc
+        alignParams = dataDoc.alignParams.copy()
+        alignParams[self.index] = (0, 0, self.zTransform, 0, 1)
+        targetCoords = dataDoc.getSliceCoords((1, 2))
+        plane = dataDoc.takeSliceFromData(dataDoc.imageArray, targetCoords,
+                alignParams = alignParams)[self.index]
+        filtered = self.parent.filterSlice(self.index, 
+                numpy.append(plane, dataDoc.getFillValue(self.index)))
+        return CostEvaluator(self.referenceData, 
+                filtered[:-1].reshape(plane.shape), filtered[-1])
+
+
+    ## Find the 2D transformation, returning it as (dx, dy, rotation, zoom).
+    def align2D(self):
+        if self.shouldUsePyramid and PYRAMID_FACTORS:
+            self.alignPyramid()
+            self.stepMultiplier = STEP_MULTIPLIER * REFINE_STEP_SCALE
+            self.refineGuess(self.cost)
+        else:
+            self.runSimplex(self.cost)
+        self.stepMultiplier = STEP_MULTIPLIER
+        return numpy.array(self.guess)
+
+
+    ## Run Simplex on the given cost function, starting from self.guess, 
+    # and leave the result in self.guess.
+    def runSimplex(self, cost):
         # Keep iterating Simplex until the cost doesn't change much from
         # one iteration to the next. Simplex is prone to getting stuck in
         # local minima that are within the initial step size of the actual
         # minimum, but not within the *current* step size -- thus, restarting
         # Simplex resets its step size and allows it to get to the true minimum.
+        self.startingCost = None
         delta = 1
-        numHits = 0
         while delta > MIN_COST_CHANGE:
             transform = scipy.optimize.fmin(
-                    self.cost, [0, 0, 0, 0],
+                    cost, [0, 0, 0, 0],
                     xtol = .00001
             )
             print "  (channel ", self.index, ")"
             delta = abs(self.currentCost - self.startingCost)
             self.startingCost = self.currentCost
-            self.guess = transform * STEP_MULTIPLIER + self.guess
+            self.guess = transform * self.stepMultiplier + self.guess
+
 
+    ## As self.runSimplex, but make a single pass, for when self.guess is 
+    # already close; self.stepMultiplier should be scaled down to match.
+    def refineGuess(self, cost):
+        self.startingCost = None
+        # Keep the same tolerance in terms of the transformation.
+        scale = (self.stepMultiplier / STEP_MULTIPLIER)[0]
+        transform = scipy.optimize.fmin(cost, [0, 0, 0, 0], 
+                xtol = .00001 / scale)
+        print "  (channel ", self.index, ")"
+        self.guess = transform * self.stepMultiplier + self.guess
+
+
+    ## Improve self.guess by aligning block-averaged copies of the reference
+    # and moving data, from the coarsest level of PYRAMID_FACTORS to the 
+    # finest. Translation steps are scaled up by each level's factor, so 
+    # that they are the same size in downsampled pixels as they are in 
+    # pixels at full resolution.
+    def alignPyramid(self):
+        reference = self.referenceData
+        moving = self.evaluator.movingData
+        levels = []
+        factor = 1
+        while factor < max(PYRAMID_FACTORS):
+            reference = pyramid.downsample(reference)
+            moving = pyramid.downsample(moving)
+            factor *= 2
+            if factor in PYRAMID_FACTORS:
+                levels.insert(0, (factor, CostEvaluator(reference, moving,
+                        self.evaluator.fillValue)))
+        for level in levels:
+            factor = level[0]
+            print "Aligning channel ", self.index, " downsampled by ", factor
+            self.pyramidLevel = level
+            self.stepMultiplier = STEP_MULTIPLIER * [factor, factor, 1, 1]
+            self.runSimplex(self.pyramidCost)
+        self.pyramidLevel = None
+
+
+    ## Find the Z translation, leaving it in self.zTransform.
+    # \param transform The 2D transformation (dx, dy, rotation, zoom) to 
+    #        apply to the moving data while aligning Z.
+    def alignZ(self, transform):
         # Now optimize the Z alignment. This requires getting transformed 3D
         # volumes from the parent, which, due to thread communication, is a bit
         # tricky.
         # No Z alignment for flat images, of course.
         print "entering Z-alignment code for channel ", self.index
         if self.parent.dataDoc.size[2] > 1:
-            self.parent.getFullVolume(self.index, self)
+            self.parent.getFullVolume(self.index, self, (transform[0], 
+                    transform[1], self.zTransform, transform[2], 
+                    transform[3]))
             while True:
                 self.dataLock.acquire()
                 # Note these are initialized to None in our constructor
@@ -246,11 +675,6 @@ class SimplexAlign(threading.Thread):
                 self.zTransform = self.zTransform + result * Z_MULTIPLIER
             #self.zTransform = result * Z_MULTIPLIER
 
-        transform = transform * STEP_MULTIPLIER + self.guess
-        transform = (transform[0], transform[1], self.zTransform,
-                     transform[2], transform[3])
-        self.parent.finishAutoAligning(transform, self.index)
-
 
     ## Accept new working volumes from our parent.
     def setVolumes(self, referenceVolume, movingVolume):
@@ -263,13 +687,21 @@ class SimplexAlign(threading.Thread):
     ## Return 1 minus the correlation coefficient between the two arrays.
     def cost(self, transform):
         # Adjust step size
-        transform = transform * STEP_MULTIPLIER + self.guess
-        # Pad out to Z for grabbing the slice.
-        fullTransform = (transform[0], transform[1], self.zTransform,
-                transform[2], transform[3])
-        self.parent.dataDoc.alignParams[self.index] = fullTransform
-        transformedMatrix = self.parent.getFilteredData(self.index)
-        cost = 1 - self.correlationCoefficient(transformedMatrix, self.referenceData)
+        transform = transform * self.stepMultiplier + self.guess
+        return self.recordCost(self.evaluator.getCost(*transform))
+
+
+    ## As self.cost, but for the downsampled data in self.pyramidLevel. 
+    # Transformations are still in terms of full-resolution pixels.
+    def pyramidCost(self, transform):
+        factor, evaluator = self.pyramidLevel
+        transform = transform * self.stepMultiplier + self.guess
+        return self.recordCost(evaluator.getCost(transform[0] / factor, 
+                transform[1] / factor, transform[2], transform[3]))
+
+
+    ## Note the latest cost, report it to our parent, and return it.
+    def recordCost(self, cost):
         if self.startingCost is None:
             self.startingCost = cost
         self.currentCost = cost
@@ -302,33 +734,90 @@ class SimplexAlign(threading.Thread):
         return numerator / numpy.sqrt(aSquared * bSquared)
 
 
-    ## Return an estimated offset (as an XY tuple) between two matrices using
-    # cross correlation.
-    def getOffset(self, a, b):
-        aFT = numpy.fft.fftn(a)
-        bFT = numpy.fft.fftn(b)
-        correlation = numpy.fft.ifftn(aFT * bFT.conj()).real
-        best = numpy.array(numpy.where(correlation == correlation.max()))
-        # They're in YX order, so flip 'em.
-        coords = best[:,0][::-1]
+    ## Return an estimated offset (as an XY array) between two matrices using
+    # cross correlation, to sub-pixel accuracy. a is taken to be the 
+    # reference, whose spectrum is cached (see getReferenceSpectrum).
+    # \param shouldApodize If true, taper both matrices to zero at their 
+    #        edges, so that the edges don't dominate the correlation.
+    def getOffset(self, a, b, shouldApodize = True):
+        aFT = getReferenceSpectrum(a, shouldApodize)
+        bFT = numpy.fft.rfft2(getApodized(b, shouldApodize))
+        correlation = numpy.fft.irfft2(aFT * bFT.conj(), a.shape)
         # Negative offsets end up on the wrong side of the image, so
         # correct for that.
-        for i, val in enumerate(coords):
-            if val > a.shape[i] / 2:
-                coords[i] -= a.transpose().shape[i]
-        try:
-            # test / debug plot of correlation
-            print "X,Y translation estimate for channel ", self.index, ": ", coords[0], ",", coords[1]
-            plt.title("correlation for channel %d" % self.index)
-            plt.imshow(correlation)
-            plt.show()
-        except NameError:
-            # HACK: plt not defined, so debug plots not shown (TODO, improve)
-            pass
+        shape = numpy.array(a.shape)
+        best = (getPeak(correlation) + shape / 2.0) % shape - shape / 2.0
+        # They're in YX order, so flip 'em.
+        coords = best[::-1]
+        print "X,Y translation estimate for channel ", self.index, ": ", coords[0], ",", coords[1]
         return coords
 
+
+## Find the same transformation as SimplexAlign, but directly rather than by
+# searching for it: the rotation and zoom from the log-polar Fourier spectra
+# of the two matrices (the Fourier-Mellin method), then the translation by
+# phase correlation. Optionally a short Simplex run polishes the result. 
+# Z translation is found as SimplexAlign finds it.
+class FourierAlign(SimplexAlign):
+    ## Instantiate the class and start aligning; parameters are as for 
+    # SimplexAlign, except that the guess is only used for its Z 
+    # translation, since the 2D transformation is found from scratch.
+    # \param shouldPolish If true, refine the result with a short Simplex run.
+    def __init__(self, parent, referenceData, index, guess,
+                 shouldAdjustGuess = False, shouldPolish = True):
+        ## Whether to polish our result with Simplex.
+        self.shouldPolish = shouldPolish
+        SimplexAlign.__init__(self, parent, referenceData, index, guess)
+
+
+    ## Find the 2D transformation, returning it as (dx, dy, rotation, zoom).
+    def align2D(self):
+        movingData = self.evaluator.movingData
+        angle, zoom = self.getRotationAndZoom(self.referenceData, movingData)
+        # The spectra can't distinguish rotations 180 degrees apart, so try
+        # both, and keep whichever correlates better once translated.
+        best = None
+        for rotation in [angle, angle - 180 if angle > 0 else angle + 180]:
+            rotated = warpPlane(movingData, 0, 0, rotation, zoom)
+            dy, dx = phaseCorrelate(self.referenceData, rotated)
+            cost = self.evaluator.getCost(dx, dy, rotation, zoom)
+            if best is None or cost < best[0]:
+                best = (cost, [dx, dy, rotation, zoom])
+        self.startingCost, self.guess = best
+        self.currentCost = self.startingCost
+        self.parent.updateAutoAlign(self.startingCost, self.currentCost, 
+                self.index)
+        print "Fourier transformation estimate for channel ", self.index, 
+        print ": ", self.guess
+        if not self.shouldPolish:
+            return numpy.array(self.guess)
+        self.stepMultiplier = POLISH_STEP_MULTIPLIER
+        transform = scipy.optimize.fmin(self.cost, [0, 0, 0, 0], 
+                xtol = .00001, maxiter = POLISH_ITERATIONS)
+        return transform * self.stepMultiplier + self.guess
+
+
+    ## Return the rotation (in degrees) and zoom that best map b onto a, up
+    # to a rotation of 180 degrees, from their log-polar spectra.
+    def getRotationAndZoom(self, a, b):
+        numAngles = numRadii = max(a.shape)
+        aPolar, radiusStep = getLogPolarSpectrum(a, numAngles, numRadii)
+        angle, zoom = 0, 1
+        for i in xrange(FOURIER_MELLIN_ITERATIONS):
+            # Rotations and zooms about the same center compose simply.
+            bPolar, radiusStep = getLogPolarSpectrum(
+                    warpPlane(b, 0, 0, angle, zoom), numAngles, numRadii)
+            radiusShift, angleShift = phaseCorrelate(aPolar, bPolar)
+            angle -= angleShift * 180. / numAngles
+            zoom *= numpy.exp(-radiusShift * radiusStep)
+        return angle, zoom
+
+
+## Maps the names of the methods AutoAligner can use to their classes.
+ALIGN_METHODS = {'simplex': SimplexAlign, 'fourier': FourierAlign}
+
+
 if __name__ == '__main__':
-    import matplotlib.pyplot as plt
     testDoc = datadoc.DataDoc('./test/testData.dv')
     testDoc.image.Mrc.info()
     print "Starting test data auto-alignment..."
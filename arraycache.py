@@ -0,0 +1,97 @@
+# Copyright 2015, Graeme Ball
+# Copyright 2012, The Regents of University of California
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+from collections import OrderedDict
+
+## Default maximum number of bytes of arrays to keep around.
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+
+## This class is a thread-safe least-recently-used cache of Numpy arrays, 
+# bounded by the total number of bytes in the arrays. Cached arrays are 
+# shared between everyone who asks for them, so they are made read-only.
+class ArrayCache:
+    ## \param maxBytes Maximum total size of the cached arrays.
+    def __init__(self, maxBytes = DEFAULT_MAX_BYTES):
+        self.maxBytes = maxBytes
+        ## Maps keys to arrays, in order of least to most recently used.
+        self.arrays = OrderedDict()
+        ## Total size in bytes of the arrays in self.arrays.
+        self.numBytes = 0
+        ## Number of successful and unsuccessful lookups.
+        self.hits = self.misses = 0
+        ## Lock around everything above.
+        self.lock = threading.Lock()
+
+
+    ## Return the array for the given key, or None if we don't have it.
+    def get(self, key):
+        with self.lock:
+            array = self.arrays.pop(key, None)
+            if array is None:
+                self.misses += 1
+                return None
+            self.arrays[key] = array
+            self.hits += 1
+            return array
+
+
+    ## Add an array to the cache, evicting the least recently used arrays as
+    # necessary to stay within our budget. Arrays larger than the whole 
+    # budget are not cached.
+    def add(self, key, array):
+        array.flags.writeable = False
+        with self.lock:
+            old = self.arrays.pop(key, None)
+            if old is not None:
+                self.numBytes -= old.nbytes
+            if array.nbytes > self.maxBytes:
+                return
+            while self.arrays and self.numBytes + array.nbytes > self.maxBytes:
+                oldKey, old = self.arrays.popitem(last = False)
+                self.numBytes -= old.nbytes
+            self.arrays[key] = array
+            self.numBytes += array.nbytes
+
+
+    ## Discard all cached arrays.
+    def clear(self):
+        with self.lock:
+            self.arrays.clear()
+            self.numBytes = 0
+
+
+    ## Return a string summarizing the cache's usage.
+    def getStatus(self):
+        with self.lock:
+            return "%d arrays, %.1f of %.1f MB; %d hits, %d misses" % (
+                    len(self.arrays), self.numBytes / 1048576., 
+                    self.maxBytes / 1048576., self.hits, self.misses)
@@ -30,12 +30,70 @@
 
 import Priithon.Mrc as Mrc
 
+import arraycache
+import imagestats
+import itertools
+import multiprocessing
 import numpy
+import os
+import pyramid
 import scipy.ndimage
+import sliceplan
+import sys
+import threading
+from collections import OrderedDict
 
 ## Maps dimensional axes to their labels.
 DIMENSION_LABELS = ['Wavelength', 'Time', 'Z', 'Y', 'X']
 
+## Maximum number of bytes of slices to keep in each DataDoc's slice cache.
+SLICE_CACHE_BYTES = 128 * 1024 * 1024
+
+## Maximum number of bytes of per-wavelength projections through single 
+# volumes to keep in each DataDoc.
+PROJECTION_CACHE_BYTES = 128 * 1024 * 1024
+
+## Fraction of the projection cache that filling in projections for other 
+# timepoints in the background may use.
+BACKGROUND_PROJECTION_FRACTION = .5
+
+## Maximum number of SlicePlans to keep in each DataDoc.
+MAX_SLICE_PLANS = 8
+
+## Maximum number of bytes of coordinate buffers a SlicePlan may use to 
+# sample every wavelength in one pass; larger slices are sampled one 
+# wavelength at a time.
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+
+## Extra pixels to read around the block of data a slice or transformed 
+# volume looks up into when interpolating with splines of order above 1, 
+# whose prefiltering depends on the data around the points being 
+# interpolated. For cubic splines the effect of the missing data falls by
+# about a factor of 4 per pixel of margin.
+SPLINE_BLOCK_MARGIN = 16
+
+## Number of rows per block when splitting volumes up between threads.
+ROWS_PER_BLOCK = 16
+
+## Default number of threads DataDoc.transformArray spreads its work over.
+# scipy.ndimage releases the GIL while it works, so these run in parallel.
+TRANSFORM_THREADS = multiprocessing.cpu_count()
+
+## Smallest size in pixels along Y or X of the tiles that exports are split
+# into to stay within a memory budget; see DataDoc.getExportTiles.
+MIN_TILE_SIZE = 32
+
+## Datatypes files can be exported as, by name; these are the MRC pixel 
+# types we can write.
+EXPORT_DTYPES = OrderedDict([(numpy.dtype(dtype).name, numpy.dtype(dtype)) 
+        for dtype in [numpy.uint8, numpy.int16, numpy.uint16, numpy.int32, 
+            numpy.float32]])
+
+## Classes of transformation, from cheapest to most expensive to apply; see
+# DataDoc.getTransformClasses.
+(TRANSFORM_IDENTITY, TRANSFORM_INTEGER, 
+        TRANSFORM_TRANSLATION, TRANSFORM_AFFINE) = range(4)
+
 ## This class contains the data model that backs the rest of the program. 
 # In other words, it's a wrapper around an MRC file (pixel data array) that
 # provides functions for loading, saving, transforming, and slicing that
@@ -47,8 +105,10 @@ class DataDoc:
     the Priithon Mrc class, and is initialized with an MRC file path.
     """
     ## Instantiate the object.
-    # \param image A loaded MRC image object.
-    def __init__(self, MRC_path):
+    # \param MRC_path Path to the MRC file to load.
+    # \param refineStats If false, don't compute exact pixel statistics in 
+    #        the background; only the initial estimates are available.
+    def __init__(self, MRC_path, refineStats = True):
         ## gb, Oct2012 - load an Mrc file here in DataDoc - previously this 
         #  Class  was initialized with an existing Mrc object.
         #  Note an Mrc object is not just a numpy ndarray of pixels.
@@ -80,11 +140,49 @@ class DataDoc:
         ## Datatype of our array.
         self.dtype = self.imageArray.dtype.type
 
+        ## Pixel statistics for each wavelength. Opening the file only reads
+        # a small sample of it (or nothing at all, if the statistics were
+        # saved the last time it was opened); exact values are computed in
+        # the background.
+        self.stats = imagestats.ImageStats(self.imageArray, self.filePath,
+                self.imageHeader._array.tostring())
         ## Averages for each wavelength, used to provide fill values when
-        # taking slices.
-        self.averages = []
-        for wavelength in xrange(self.numWavelengths):
-            self.averages.append(self.imageArray[wavelength].mean())
+        # taking slices. These start out as estimates and are updated in 
+        # place once the exact statistics are available.
+        self.averages = self.stats.getMeans()
+        if refineStats:
+            self.stats.refineInBackground(self.onStatsRefined)
+
+        ## Downsampled XY sections, for displaying large images.
+        self.pyramid = pyramid.PyramidCache(self.imageArray)
+
+        ## Recently-generated slices and projections, so that redrawing
+        # something we've already shown doesn't mean recomputing it.
+        self.sliceCache = arraycache.ArrayCache(SLICE_CACHE_BYTES)
+        ## Projections through the volumes of single wavelengths at single 
+        # timepoints. Projections through transformed volumes are keyed by 
+        # the alignment parameters of just that wavelength, so that 
+        # changing one wavelength's parameters only means transforming that
+        # wavelength again.
+        self.projectionCache = arraycache.ArrayCache(PROJECTION_CACHE_BYTES)
+        ## Axis and list of timepoints that a background thread is filling 
+        # in (or has filled in) untransformed projections for (see 
+        # fillProjectionsInBackground), if any.
+        self.backgroundProjectionFill = None
+        ## Lock around self.backgroundProjectionFill.
+        self.backgroundProjectionLock = threading.Lock()
+
+        ## Maps (data shape, slice axes) to SlicePlans for taking transformed
+        # slices of that geometry, in order of least to most recently used.
+        self.slicePlans = OrderedDict()
+        ## Lock around self.slicePlans.
+        self.slicePlansLock = threading.Lock()
+        ## Alignment parameters, as a string, and the inverse transformation
+        # matrices for them; see getInverseTransforms.
+        self.inverseTransforms = (None, None)
+
+        ## Number of threads transformArray uses by default.
+        self.numTransformThreads = TRANSFORM_THREADS
 
         ## Lower boundary of the cropped data.
         self.cropMin = numpy.array([0, 0, 0, 0, 0], numpy.int32)
@@ -113,95 +211,281 @@ class DataDoc:
         self.channelWaves = self.getChannelWaves()
 
 
+    ## Receive exact statistics from self.stats.
+    def onStatsRefined(self, stats):
+        self.averages[:] = stats.getMeans()
+        # Cached transformed slices used the old averages as fill values.
+        self.sliceCache.clear()
+
+
     ## Convert the loaded MRC object into a 5D array of pixel data. How we
     # do this depends on the ordering of X/Y/Z/time/wavelength in the file --
     # the problem being that the shape of the array in the file is not padded
     # out with dimensions that are length 1 (e.g. a file with 1 wavelength).
     # So we pad out the default array until it is five-dimensional, and then
     # rearrange its axes until its ordering is WTZYX.
+    # The result is a read-only strided view onto the memory-mapped file, not
+    # a copy, so pixel data is only paged in from disk when a slice of the
+    # array actually touches it. For very large files it is instead a 
+    # Mrc.WindowedArray, which only maps the sections that are accessed.
     def getImageArray(self):
         # This is a string describing the dimension ordering as stored in 
         # the file.
         sequence = self.image.Mrc.axisOrderStr()
         dimOrder = ['w', 't', 'z', 'y', 'x']
         vals = zip(self.size, dimOrder)
-        dataCopy = numpy.array(self.image)
+        data = self.image
+        if isinstance(data, numpy.ndarray):
+            # Drop the Mrc subclass so that views of the data are plain 
+            # arrays.
+            data = data.view(numpy.ndarray)
         # Find missing axes and pad the array until it has 5 axes.
         for val, key in vals[:2]:
             # The wavelength and time dimensions are left off if they have
             # length 1.
             if val == 1:
                 # The array is missing a dimension, so pad it out.
-                dataCopy = numpy.expand_dims(dataCopy, -1)
+                data = data.reshape(data.shape + (1,))
                 sequence = sequence + key
         # Generate a list of how we need to reorder the axes.
         ordering = []
         for val, key in vals:
             ordering.append(sequence.index(key))
 
-        return dataCopy.transpose(ordering)
+        data = data.transpose(ordering)
+        if isinstance(data, numpy.ndarray):
+            # Nothing should write back into the file through this view.
+            data.flags.writeable = False
+        return data
 
 
-    ## Passthrough to takeSliceFromData, using our normal array.
+    ## Passthrough to takeSliceFromData, using our normal array. Results are
+    # cached, so the returned array is read-only. The auto-aligner changes 
+    # self.alignParams from other threads, so the cache key and the slice 
+    # come from a single copy of them.
     def takeSlice(self, axes, shouldTransform = True, order = 1):
-        return self.takeSliceFromData(self.imageArray, axes, shouldTransform, order)
+        alignParams = self.alignParams.copy()
+        key = ('slice', tuple(sorted(axes.items())), shouldTransform, order,
+                alignParams.tostring())
+        result = self.sliceCache.get(key)
+        if result is None:
+            result = self.takeSliceFromData(self.imageArray, axes, 
+                    shouldTransform, order, alignParams)
+            self.sliceCache.add(key, result)
+        return result
+
+
+    ## Return an untransformed XY slice through each wavelength at the given
+    # timepoint and Z index, block-averaged down by a factor of 2 ** level.
+    # Downsampled slices are cached, so this is cheap once the level has 
+    # been generated.
+    def takeDownsampledSlice(self, timepoint, z, level):
+        return numpy.array([self.pyramid.getLevel(wavelength, timepoint, z, level)
+                for wavelength in xrange(self.numWavelengths)])
 
 
     ## As takeSlice, but do a max-intensity projection across one axis. This
     # becomes impossible to do efficiently if we have rotation or scaling in
-    # a given wavelength, so we just have to transform the entire volume. It
-    # gets *really* expensive if we want to do projections across time with 
-    # this...
-    # \todo We could be a bit more efficient here since only the wavelengths
-    # with nonzero rotation/scaling need to be transformed as volumes. 
+    # a given wavelength, so we just have to transform the entire volume. 
+    # Projections through X or Y are cached per wavelength (see 
+    # getChannelProjection), so only wavelengths whose parameters changed 
+    # need transforming again. It gets *really* expensive if we want to do
+    # projections across time with this, though see projectThroughTime.
+    # \param progressCallback Function to pass on to projectThroughTime when
+    #        projecting through time.
     def takeProjectedSlice(self, axes, projectionAxis, shouldTransform,
-            order = 1):
+            order = 1, progressCallback = None):
+        # As in takeSlice, use one copy of the alignment parameters for both
+        # the key and the projection.
+        alignParams = self.alignParams.copy()
+        key = ('projection', tuple(sorted(axes.items())), projectionAxis, 
+                shouldTransform, order, alignParams.tostring())
+        result = self.sliceCache.get(key)
+        if result is None:
+            result = self.makeProjectedSlice(dict(axes), projectionAxis, 
+                    shouldTransform, order, progressCallback, alignParams)
+            self.sliceCache.add(key, result)
+        return result
+
+
+    ## Generate the projection for takeProjectedSlice, bypassing the cache.
+    # \param alignParams Alignment parameters to use; by default, a copy of
+    #        self.alignParams.
+    def makeProjectedSlice(self, axes, projectionAxis, shouldTransform,
+            order = 1, progressCallback = None, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams.copy()
         if (projectionAxis == 2 or 
-                (numpy.all(self.alignParams[:,3] == 0) and 
-                 numpy.all(self.alignParams[:,4] == 1))):
+                (numpy.all(alignParams[:,3] == 0) and 
+                 numpy.all(alignParams[:,4] == 1))):
             # Scaling/rotation doesn't affect the projection; lucky us!
-            data = self.imageArray.max(axis = projectionAxis)
+            if projectionAxis != 1 and 1 in axes:
+                # We only need the projections at one timepoint.
+                timepoint = axes[1]
+                data = numpy.array([self.getRawProjection(wavelength, 
+                        timepoint, projectionAxis)
+                        for wavelength in xrange(self.size[0])])
+                data = numpy.expand_dims(data, 1)
+                axes[1] = 0
+                self.fillProjectionsInBackground(projectionAxis, timepoint)
+            else:
+                data = self.imageArray.max(axis = projectionAxis)
             # Augment data with an extra dimension to replace the one we
             # flattened out.
             data = numpy.expand_dims(data, projectionAxis)
             # Since we flattened out this axis, change its index to be the only
             # possible valid index.
             axes[projectionAxis] = 0
-            return self.takeSliceFromData(data, axes, shouldTransform, order)
+            return self.takeSliceFromData(data, axes, shouldTransform, order,
+                    alignParams)
         elif projectionAxis in [3, 4]:
-            # Projecting through Y or X; just transform the local volume.
-            curTimepoint = self.curViewIndex[1]
-            data = []
-            for wavelength in xrange(self.size[0]):
-                data.append(self.transformArray(
-                        self.imageArray[wavelength, curTimepoint], 
-                        *self.alignParams[wavelength], 
-                        order = 1))
-            data = numpy.array(data, dtype = self.dtype)
-            return data.max(axis = projectionAxis - 1)
+            # Projecting through Y or X; just transform the local volume, at 
+            # the requested timepoint (which the prefetcher may set ahead of
+            # the view).
+            timepoint = axes.get(1, self.curViewIndex[1])
+            return numpy.array([self.getChannelProjection(wavelength, 
+                    timepoint, projectionAxis, alignParams[wavelength])
+                    for wavelength in xrange(self.size[0])])
         else:
             # Projecting through time; transform EVERY volume. Ouch.
-            data = []
-            for timepoint in xrange(self.size[1]):
-                timeData = []
-                for wavelength in xrange(self.size[0]):
-                    volume = self.transformArray(
-                            self.imageArray[wavelength, timepoint], 
-                            *self.alignParams[wavelength], 
-                            order = 1)
-                    timeData.append(volume)
-                timeData = numpy.array(timeData, dtype = self.dtype)
-                data.append(timeData)
-                
-            data = numpy.array(data, dtype = self.dtype)
-            data = data.max(axis = 0)
-            # Slice through data per our axes parameter.
-            slice = [Ellipsis] * 4
-            for axis, position in axes.iteritems():
-                if axis != 1:
-                    slice[axis - 1] = position
-                    return data[slice]
+            return self.projectThroughTime(axes, progressCallback, 
+                    alignParams)
+
+
+    ## Return the maximum intensity projection through Z, Y, or X of the 
+    # untransformed volume for one wavelength at one timepoint. Projections
+    # are cached, so switching back and forth between timepoints doesn't 
+    # mean scanning their volumes again.
+    # \param projectionAxis 2, 3, or 4 to project through Z, Y, or X.
+    def getRawProjection(self, wavelength, timepoint, projectionAxis):
+        key = ('raw projection', wavelength, timepoint, projectionAxis)
+        result = self.projectionCache.get(key)
+        if result is None:
+            result = self.imageArray[wavelength, timepoint].max(
+                    axis = projectionAxis - 2)
+            self.projectionCache.add(key, result)
+        return result
+
+
+    ## Start a thread generating the untransformed projections through the
+    # given axis for every timepoint, nearest the given one first, so that
+    # they are ready by the time the user moves to them. Only as many 
+    # timepoints as fit in our share of the projection cache are done. 
+    # Nothing happens if the timepoint is among those already being done 
+    # (or done) for the axis; otherwise a new fill, centered on the 
+    # timepoint, stops the previous thread.
+    def fillProjectionsInBackground(self, projectionAxis, timepoint):
+        with self.backgroundProjectionLock:
+            fill = self.backgroundProjectionFill
+            if (fill is not None and fill[0] == projectionAxis and 
+                    timepoint in fill[1]):
+                return
+            numPixels = (numpy.product(self.size[2:]) // 
+                    self.size[projectionAxis])
+            timepointBytes = (numPixels * self.size[0] * 
+                    numpy.dtype(self.dtype).itemsize)
+            maxTimepoints = int(PROJECTION_CACHE_BYTES * 
+                    BACKGROUND_PROJECTION_FRACTION // timepointBytes)
+            if not maxTimepoints:
+                return
+            timepoints = sorted(xrange(self.size[1]), 
+                    key = lambda t: abs(t - timepoint))[:maxTimepoints]
+            fill = (projectionAxis, timepoints)
+            self.backgroundProjectionFill = fill
+        thread = threading.Thread(target = self.fillProjections, 
+                args = (fill,))
+        thread.daemon = True
+        thread.start()
+
+
+    ## Generate projections for fillProjectionsInBackground.
+    # \param fill The (axis, timepoints) pair to generate projections for.
+    def fillProjections(self, fill):
+        projectionAxis, timepoints = fill
+        for t in timepoints:
+            for wavelength in xrange(self.size[0]):
+                if self.backgroundProjectionFill is not fill:
+                    # We've been superseded.
+                    return
+                self.getRawProjection(wavelength, t, projectionAxis)
+
+
+    ## Return the maximum intensity projection through Y or X of the 
+    # transformed volume for one wavelength at one timepoint, in self.dtype.
+    # Transforming the volume is what costs, so we project it through both 
+    # axes at once and cache the results under the wavelength's current 
+    # alignment parameters; moving around in the projection, or changing 
+    # another wavelength's parameters, then doesn't need it transformed 
+    # again.
+    # \param projectionAxis 3 to project through Y, 4 for X.
+    # \param params The wavelength's alignment parameters; by default, a 
+    #        copy of its current ones.
+    def getChannelProjection(self, wavelength, timepoint, projectionAxis,
+            params = None):
+        if params is None:
+            params = self.alignParams[wavelength].copy()
+        paramsKey = params.tostring()
+        keys = dict([(axis, 
+                ('projection', wavelength, timepoint, axis, paramsKey))
+                for axis in (3, 4)])
+        result = self.projectionCache.get(keys[projectionAxis])
+        if result is None:
+            volume = self.transformArray(
+                    self.imageArray[wavelength, timepoint], 
+                    *params, order = 1)
+            for axis, key in keys.iteritems():
+                projection = volume.max(axis = axis - 2).astype(self.dtype)
+                self.projectionCache.add(key, projection)
+                if axis == projectionAxis:
+                    result = projection
+        return result
+
+
+    ## Take the maximum intensity projection through time of the transformed
+    # data, and slice it per the given axes, as for takeProjectedSlice. 
+    # Volumes are transformed one at a time into a running maximum, and only
+    # the slab of each volume that the slice passes through is resampled, 
+    # so memory use doesn't grow with the number of timepoints.
+    # \param axes Maps the time axis and one spatial axis to positions, as
+    #        for takeSlice; the time position is ignored.
+    # \param progressCallback Function to call, if any, with the number of 
+    #        timepoints done and the total number after each timepoint.
+    # \param alignParams Alignment parameters to use; by default, a copy of
+    #        self.alignParams.
+    # \return A WXY-style array of slices, one per wavelength, in self.dtype.
+    def projectThroughTime(self, axes, progressCallback = None, 
+            alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams.copy()
+        spatialAxes = [axis for axis in axes if axis != 1]
+        if not spatialAxes:
             raise RuntimeError("Couldn't find a valid slice axis.")
+        axis = spatialAxes[0]
+        # ZYX region of each volume the slice passes through.
+        region = [slice(0, size) for size in self.size[2:]]
+        region[axis - 2] = slice(axes[axis], axes[axis] + 1)
+        region = tuple(region)
+        regionShape = tuple([r.stop - r.start for r in region])
+        projection = numpy.empty((self.size[0],) + regionShape, numpy.float32)
+        volume = numpy.empty(regionShape, numpy.float32)
+        numTimepoints = self.size[1]
+        for timepoint in xrange(numTimepoints):
+            for wavelength in xrange(self.size[0]):
+                target = volume
+                if timepoint == 0:
+                    target = projection[wavelength]
+                self.transformArray(self.getVolume(wavelength, timepoint), 
+                        *alignParams[wavelength], order = 1, 
+                        output = target, region = region, 
+                        fillValue = self.getVolumeMin(wavelength, timepoint))
+                if timepoint:
+                    numpy.maximum(projection[wavelength], volume, 
+                            projection[wavelength])
+            if progressCallback is not None:
+                progressCallback(timepoint + 1, numTimepoints)
+        # Casting is monotonic, so casting the maximum is the same as taking
+        # the maximum of the cast volumes.
+        return projection.squeeze(axis - 1).astype(self.dtype)
 
 
     ## Generate a 2D slice of the given data in each wavelength. Since the
@@ -213,64 +497,30 @@ class DataDoc:
     # 10 through Z index 32.
     # This was fairly complicated for me to figure out, since I'm not a 
     # scientific programmer, so I'm including my general process here:
-    # - Figure out which axes the slice cuts across, and generate an array
-    #   of the appropriate shape to hold the results.
-    # - Create an array of similar size augmented with a length-4 dimension.
-    #   This array holds XYZ coordinates for each pixel in the slice; the 4th
-    #   index holds a 1 (so that we can use a 4x4 affine transformation matrix
-    #   to do rotation and offsets in the same pass). For example, an XY slice
-    #   at Z = 5 would look something like this:
-    # [  [0, 0, 5]  [0, 1, 5]  [0, 2, 5] ...
-    # [  [1, 0, 5]  ...
-    # [  [2, 0, 5]
-    # [  ...
-    # [
-    # - Subtract the XYZ center off of the coordinates so that when we apply
-    #   the rotation transformation, it's done about the center of the dataset
-    #   instead of the corner.
-    # - Multiply the inverse transformation matrix by the coordinates.
-    # - Add the center back on.
-    # - Chop off the dummy 1 coordinate, reorder to ZYX, and prepend the time
-    #   dimension.
-    # - Pass the list of coordinates off to numpy.map_coordinates so it can
+    # - Figure out which axes the slice cuts across, and get the SlicePlan 
+    #   for slices of that geometry, which holds a buffer of the appropriate
+    #   shape and the XYZ coordinates of the slice's pixels along each of 
+    #   its two dimensions.
+    # - For each wavelength, have the plan fill in the buffer with the 
+    #   coordinates to look up: the slice's pixel coordinates, with the XYZ
+    #   center subtracted (so that rotation is done about the center of the
+    #   dataset instead of the corner), multiplied by the inverse 
+    #   transformation matrix, with the center added back on, in ZYX order
+    #   (with time prepended if the slice cuts across time).
+    # - Pass the coordinates off to scipy.ndimage.map_coordinates so it can
     #   look up actual pixel values.
-    # - Reshape the resulting array to match the slice shape.
-    def takeSliceFromData(self, data, axes, shouldTransform = True, order = 1):
+    # \param alignParams Alignment parameters to use; by default, a copy of
+    #        self.alignParams. Passing them in lets callers take slices with
+    #        parameters other than the current ones, and ensures they don't
+    #        change part way through.
+    def takeSliceFromData(self, data, axes, shouldTransform = True, order = 1,
+            alignParams = None):
         if shouldTransform:
-            targetShape = []
-            targetAxes = []
-            presets = [-1] * 5
-            # Generate an array to hold the slice. Note this includes all
-            # wavelengths.
-            for i, size in enumerate(data.shape):
-                if i not in axes:
-                    targetShape.append(size)
-                    targetAxes.append(i)
-                else:
-                    presets[i] = axes[i]
-
-            # Create a matrix of size (NxMx3) where N and M are the width
-            # and height of the desired slice, and the remaining dimension 
-            # holds the desired XYZ coordinates for each pixel in the slice,
-            # pre-transform. Note this is wavelength-agnostic.
-            targetCoords = numpy.empty(targetShape[1:] + [3])
-            haveAlreadyResized = False
-            # Axes here are in WTZYX order, so we need to reorder them to XYZ.
-            for axis in [2, 3, 4]:
-                if axis in targetAxes:
-                    basis = numpy.arange(data.shape[axis])
-                    if (data.shape[axis] == targetCoords.shape[0] and 
-                            not haveAlreadyResized):
-                        # Reshape into a column vector. We only want to do this
-                        # once, but unfortunately can't tell solely with the 
-                        # length of the array in the given axis since it's not
-                        # uncommon for e.g. X and Y to have the same size.
-                        basis.shape = data.shape[axis], 1
-                        haveAlreadyResized = True
-                    targetCoords[:,:,4 - axis] = basis
-                else:
-                    targetCoords[:,:,4 - axis] = axes[axis]
-            return self.mapCoords(data, targetCoords, targetShape, axes, order)
+            if alignParams is None:
+                alignParams = self.alignParams.copy()
+            targetAxes = [axis for axis in xrange(1, 5) if axis not in axes]
+            plan = self.getSlicePlan(data.shape, targetAxes)
+            return self.mapCoords(data, plan, axes, order, alignParams)
         else:
             # Simply take an ordinary slice.
             # Ellipsis is a builtin keyword for the full-array slice. Who knew?
@@ -283,70 +533,188 @@ class DataDoc:
             return data[slices]
 
 
-    ## Inverse-transform the provided coordinates and use them to look up into
-    # the given array, to generate a transformed slice of the specified shape
-    # along the specified axes.
+    ## Use the given SlicePlan to look up into the given array, generating a
+    # transformed slice through each wavelength.
     # \param data A 5D array of pixel data (WTZYX)
-    # \param targetCoords 4D array of WXYZ coordinates.
-    # \param targetShape Shape of the resulting slice.
-    # \param axes Axes the slice cuts along.
+    # \param plan SlicePlan for the slice's geometry.
+    # \param axes Maps the axes the slice is perpendicular to, to the 
+    #        positions it passes through.
     # \param order Spline order to use when mapping. Lower is faster but 
     #        less accurate
-    def mapCoords(self, data, targetCoords, targetShape, axes, order):
-        # Reshape into a 2D list of the desired coordinates
-        targetCoords.shape = numpy.product(targetShape[1:]), 3
-        # Insert a dummy 4th dimension so we can use translation in an 
-        # affine transformation.
-        tmp = numpy.empty((targetCoords.shape[0], 4))
-        tmp[:,:3] = targetCoords
-        tmp[:,3] = 1
-        targetCoords = tmp
-
-        transforms = self.getTransformationMatrices()
-        inverseTransforms = [numpy.linalg.inv(matrix) for matrix in transforms]
-        transposedCoords = targetCoords.T
-        # XYZ center, which needs to be added and subtracted from the 
-        # coordinates before/after transforming so that rotation is done
-        # about the center of the image.
-        center = numpy.array(data.shape[2:][::-1]).reshape(3, 1) / 2.0
-        transposedCoords[:3,:] -= center
-        result = numpy.zeros(targetShape, dtype = self.dtype)
-        for wavelength in xrange(data.shape[0]):
-            # Transform the coordinates according to the alignment 
-            # parameters for the specific wavelength.
-            transformedCoords = numpy.dot(inverseTransforms[wavelength],
-                    transposedCoords)
-            transformedCoords[:3,:] += center
-
-            # Chop off the trailing 1, reorder to ZYX, and insert the time
-            # coordinate.
-            tmp = numpy.zeros((4, transformedCoords.shape[1]), dtype = numpy.float)
-            for i in xrange(3):
-                tmp[i + 1] = transformedCoords[2 - i]
-
-            transformedCoords = tmp
-            if 1 not in axes:
-                # User wants a cut across time.
-                transformedCoords[0,:] = numpy.arange(data.shape[1]).repeat(
-                        transformedCoords.shape[1] / data.shape[1])
+    # \param alignParams Alignment parameters to transform by.
+    def mapCoords(self, data, plan, axes, order, alignParams):
+        result = numpy.empty((data.shape[0],) + plan.sliceShape, 
+                dtype = self.dtype)
+        # Wavelengths that have to be interpolated; the rest are just 
+        # shifted by whole pixels.
+        interpolated = []
+        for wavelength, transformClass in enumerate(
+                self.getTransformClasses(alignParams)):
+            if transformClass in [TRANSFORM_IDENTITY, TRANSFORM_INTEGER]:
+                self.shiftSlice(data, plan, axes, wavelength, 
+                        result[wavelength], alignParams[wavelength])
             else:
-                transformedCoords[0,:] = axes[1]
-
-            resultVals = scipy.ndimage.map_coordinates(
-                    data[wavelength], transformedCoords, 
-                    order = order, cval = self.averages[wavelength])
-            resultVals.shape = targetShape[1:]
-            result[wavelength] = resultVals
-            
+                interpolated.append(wavelength)
+        if not interpolated:
+            return result
+        inverseTransforms = self.getInverseTransforms(alignParams)
+        if order <= 1 and plan.getBatchBytes() <= MAX_BATCH_BYTES:
+            self.mapCoordsBatched(data, plan, axes, order, 
+                    inverseTransforms, interpolated, result)
+            return result
+        margin = 0
+        if order > 1:
+            margin = SPLINE_BLOCK_MARGIN
+        for wavelength in interpolated:
+            with plan.lock:
+                coords = plan.getCoords(inverseTransforms[wavelength], axes)
+                # Only read in the part of the volume the slice passes 
+                # through; for in-plane transforms that's just the one or 
+                # two Z slices around it.
+                block = plan.cropCoords(coords, data.shape[2:], margin)
+                if block is None:
+                    result[wavelength] = self.getFillValue(wavelength)
+                    continue
+                if plan.isTimeCut:
+                    volume = data[(wavelength, slice(None)) + block]
+                else:
+                    volume = data[(wavelength, axes[1]) + block]
+                result[wavelength] = scipy.ndimage.map_coordinates(
+                        volume, coords, 
+                        order = order, cval = self.averages[wavelength])
         return result
 
 
+    ## As mapCoords, but sample the given wavelengths in a single pass, 
+    # treating wavelength as one more axis to interpolate along. That only 
+    # works for spline orders up to 1, since higher orders would blend 
+    # neighbouring wavelengths together; for order 1, integer wavelength 
+    # coordinates give each wavelength's values exactly. Since the fill 
+    # value for points outside the data differs per wavelength, we fill 
+    # with NaN and replace that afterwards, then round to our datatype the 
+    # way map_coordinates does.
+    # \param wavelengths Increasing list of wavelengths to sample.
+    # \param result Array to write the slices into, indexed by wavelength.
+    def mapCoordsBatched(self, data, plan, axes, order, inverseTransforms,
+            wavelengths, result):
+        with plan.lock:
+            coords = plan.getBatchCoords(inverseTransforms, axes, wavelengths)
+            values = plan.batchOutput[:len(wavelengths)]
+            block = plan.cropCoords(coords, data.shape[2:])
+            if block is None:
+                values.fill(numpy.nan)
+            else:
+                # Only read in the wavelengths and the part of the volume 
+                # the slice passes through.
+                wavelengthRange = slice(wavelengths[0], wavelengths[-1] + 1)
+                if plan.isTimeCut:
+                    volume = data[(wavelengthRange, slice(None)) + block]
+                else:
+                    volume = data[(wavelengthRange, axes[1]) + block]
+                scipy.ndimage.map_coordinates(volume, coords, 
+                        output = values, order = order, cval = numpy.nan)
+            for i, wavelength in enumerate(wavelengths):
+                channel = values[i]
+                channel[numpy.isnan(channel)] = self.averages[wavelength]
+            self.castToDtype(values)
+            for i, wavelength in enumerate(wavelengths):
+                result[wavelength] = values[i]
+
+
+    ## Generate a slice through one wavelength whose transform is a shift 
+    # by a whole number of pixels (possibly zero), by plain indexing. This 
+    # gives the same result as interpolating, without the cost.
+    # \param output Array to write the slice into.
+    # \param params The wavelength's alignment parameters.
+    def shiftSlice(self, data, plan, axes, wavelength, output, params):
+        dx, dy, dz = params[:3]
+        shifts = {2: int(dz), 3: int(dy), 4: int(dx)}
+        output[:] = self.getFillValue(wavelength)
+        source = [wavelength]
+        target = []
+        for axis in xrange(1, 5):
+            size = data.shape[axis]
+            shift = shifts.get(axis, 0)
+            if axis in plan.targetAxes:
+                start = max(0, shift)
+                end = min(size, size + shift)
+                if start >= end:
+                    # The slice is shifted entirely out of the data.
+                    return
+                target.append(slice(start, end))
+                source.append(slice(start - shift, end - shift))
+            else:
+                index = axes[axis] - shift
+                if not 0 <= index < size:
+                    return
+                source.append(index)
+        output[tuple(target)] = data[tuple(source)]
+
+
+    ## Return the value map_coordinates would use for points outside the 
+    # data in the given wavelength: its average, in our datatype.
+    def getFillValue(self, wavelength):
+        return self.castToDtype(numpy.array(self.averages[wavelength], 
+                dtype = numpy.float64))
+
+
+    ## Convert the given floating-point array in-place so that it holds 
+    # values of our datatype, rounding halves away from zero for integer 
+    # datatypes, as map_coordinates does.
+    def castToDtype(self, values):
+        if not numpy.issubdtype(self.dtype, numpy.inexact):
+            values += numpy.copysign(0.5, values)
+            numpy.trunc(values, values)
+        return values
+
+
+    ## Return the SlicePlan for slices of the given geometry, making it if 
+    # necessary. Only the most recently used few plans are kept.
+    # \param shape Shape of the 5D data slices are taken from.
+    # \param targetAxes Non-wavelength axes the slices cut across.
+    def getSlicePlan(self, shape, targetAxes):
+        key = (tuple(shape), tuple(targetAxes))
+        with self.slicePlansLock:
+            plan = self.slicePlans.pop(key, None)
+            if plan is None:
+                plan = sliceplan.SlicePlan(shape, targetAxes)
+            self.slicePlans[key] = plan
+            while len(self.slicePlans) > MAX_SLICE_PLANS:
+                self.slicePlans.popitem(last = False)
+        return plan
+
+
+    ## Return the inverses of the matrices from getTransformationMatrices.
+    # These are only recomputed when the alignment parameters change.
+    # \param alignParams Alignment parameters to use; by default, a copy of
+    #        self.alignParams. The matrices are cached under the parameters 
+    #        they were computed from.
+    def getInverseTransforms(self, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams.copy()
+        version = alignParams.tostring()
+        cachedVersion, inverseTransforms = self.inverseTransforms
+        if version != cachedVersion:
+            inverseTransforms = [numpy.linalg.inv(matrix) 
+                    for matrix in self.getTransformationMatrices(alignParams)]
+            self.inverseTransforms = (version, inverseTransforms)
+        return inverseTransforms
+
+
+    ## Return the ZYX volume for the given wavelength and timepoint, without
+    # reading it in if the data is only mapped in on demand, so that callers
+    # can read just the parts of it they need.
+    def getVolume(self, wavelength, timepoint):
+        if isinstance(self.imageArray, Mrc.WindowedArray):
+            return self.imageArray.lazyIndex(wavelength, timepoint)
+        return self.imageArray[wavelength, timepoint]
+
+
     ## Return the value for each wavelength at the specified TZYX coordinate, 
     # taking transforms into account. Also return the transformed coordinates.
     # \todo This copies a fair amount of logic from self.mapCoords.
     def getValuesAt(self, coord):
-        transforms = self.getTransformationMatrices()
-        inverseTransforms = [numpy.linalg.inv(matrix) for matrix in transforms]
+        inverseTransforms = self.getInverseTransforms()
         # Reorder to XYZ and add a dummy 4th dimension.
         transposedCoord = numpy.array([[coord[3]], [coord[2]], 
             [coord[1]], [1]])
@@ -373,7 +741,8 @@ class DataDoc:
             transformedCoord.shape = 4, 1
 
             resultVals[wavelength] = scipy.ndimage.map_coordinates(
-                    self.imageArray[wavelength], transformedCoord, 
+                    self.imageArray[wavelength, int(coord[0])], 
+                    transformedCoord[1:], 
                     order = 1, cval = self.averages[wavelength])[0]
         return resultVals, resultCoords
 
@@ -385,37 +754,190 @@ class DataDoc:
         return self.takeSlice(targetCoords, shouldTransform)
 
     ## Apply a transformation to an input 3D array in ZYX order. Angle rotates      
-    # each slice, zoom scales each slice (i.e. neither is 3D).                      
-    def transformArray(self, inData, dx, dy, dz, angle, zoom, order = 3):                  
-        # Input angle is in degrees, but scipy's transformations expect angles      
-        # in radians.                                                               
-        angle = angle * numpy.pi / 180                                              
-        cosTheta = numpy.cos(-angle)                                                
-        sinTheta = numpy.sin(-angle)                                                
-        affineTransform = zoom * numpy.array(                                       
-                [[cosTheta, sinTheta], [-sinTheta, cosTheta]])                      
-                                                                                    
-        invertedTransform = numpy.linalg.inv(affineTransform)                       
-        yxCenter = numpy.array(inData.shape[1:]) / 2.0                               
-        offset = -numpy.dot(invertedTransform, yxCenter) + yxCenter                 
-                                                                                    
-        output = numpy.zeros(inData.shape)                                           
-        for i, dataSlice in enumerate(inData):                                           
-            output[i] = scipy.ndimage.affine_transform(dataSlice, invertedTransform,    
-                    offset, output = numpy.float32, cval = dataSlice.min(),             
-                    order = order)                                                  
-        output = scipy.ndimage.interpolation.shift(output, [dz, dy, dx],            
-                order = order)                                                      
-                                                                                    
+    # each slice, zoom scales each slice (i.e. neither is 3D). The data is 
+    # only interpolated once: since the transformation doesn't mix Z with 
+    # X and Y, the 3D spline interpolation separates into a shift along Z 
+    # followed by a rotation, zoom, and XY shift of each slice, which is 
+    # much cheaper than a general 3D resample. Points that map to outside 
+    # the input get its minimum value.
+    # \param inData The input array; only the part of it needed for the 
+    #        output region is read, so this may be a view onto a file.
+    # \param output Optional float32 array of the shape of the output 
+    #        region to write the result into, so callers transforming many 
+    #        volumes can reuse one buffer; by default a new one is allocated.
+    # \param region Optional tuple of ZYX slices (with explicit starts and 
+    #        stops) selecting the part of the transformed volume to compute;
+    #        by default, all of it.
+    # \param fillValue Value for points that map to outside the input, if 
+    #        already known; by default the minimum of inData.
+    # \param numThreads Number of threads to spread the slices over; by 
+    #        default self.numTransformThreads.
+    # \return The float32 transformed array.
+    def transformArray(self, inData, dx, dy, dz, angle, zoom, order = 3,
+            output = None, region = None, fillValue = None, 
+            numThreads = None):
+        invertedTransform, offset = getYXTransform(inData.shape[1:], 
+                dx, dy, angle, zoom)
+        if region is None:
+            region = tuple([slice(0, size) for size in inData.shape])
+        regionStart = numpy.array([r.start for r in region])
+        regionShape = tuple([r.stop - r.start for r in region])
+        if output is None:
+            output = numpy.empty(regionShape, numpy.float32)
+        if fillValue is None:
+            fillValue = inData.min()
+        block = self.getSourceBlock(inData.shape, invertedTransform, offset, 
+                dz, region, order)
+        if block is None:
+            # The region maps entirely outside the input.
+            output[:] = fillValue
+            return output
+        source = numpy.asarray(inData[block])
+        # Express the transformation relative to the block we read in and 
+        # the region we write out.
+        blockStart = numpy.array([b.start for b in block])
+        dz = dz - regionStart[0] + blockStart[0]
+        offset = (offset + numpy.dot(invertedTransform, regionStart[1:]) - 
+                blockStart[1:])
+
+        if numThreads is None:
+            numThreads = self.numTransformThreads
+        shifted = output
+        if source.shape[1:] != regionShape[1:]:
+            shifted = numpy.empty((regionShape[0],) + source.shape[1:], 
+                    numpy.float32)
+        validSlices = self.shiftVolumeZ(source, dz, order, fillValue, shifted,
+                numThreads)
+        if shifted is not output or dx or dy or angle or zoom != 1:
+            def transformSlices(indices):
+                plane = numpy.empty(regionShape[1:], numpy.float32)
+                for i in indices:
+                    if i not in validSlices:
+                        output[i] = fillValue
+                        continue
+                    scipy.ndimage.affine_transform(shifted[i], 
+                            invertedTransform, offset, 
+                            output_shape = plane.shape, output = plane, 
+                            cval = fillValue, order = order)
+                    output[i] = plane
+            runInThreads(transformSlices, range(len(output)), numThreads)
         return output
 
 
-    ## Generate a 4D transformation matrix based on self.alignParams for
-    # each wavelength.
-    def getTransformationMatrices(self):
+    ## Work out which block of a ZYX volume transformArray needs to read to 
+    # fill in a given region of its output: the bounding box of where the 
+    # region maps to, plus a margin for spline prefiltering along any axis
+    # that needs interpolating.
+    # \param shape Shape of the volume.
+    # \param invertedTransform, offset Map output YX coordinates to input 
+    #        ones, as for scipy.ndimage.affine_transform.
+    # \param dz Shift along Z.
+    # \param region Tuple of ZYX slices of the output.
+    # \return A tuple of ZYX slices of the volume, or None if the region 
+    #         maps entirely outside it.
+    def getSourceBlock(self, shape, invertedTransform, offset, dz, region, 
+            order):
+        margin = 0
+        if order > 1:
+            margin = SPLINE_BLOCK_MARGIN
+        # Ranges of input coordinates along each axis, with their margins.
+        ranges = [(region[0].start - dz, region[0].stop - 1 - dz, 
+                margin * (dz != int(dz)))]
+        corners = numpy.array([[y, x] 
+                for y in [region[1].start, region[1].stop - 1] 
+                for x in [region[2].start, region[2].stop - 1]]).T
+        positions = (numpy.dot(invertedTransform, corners) + 
+                offset.reshape(2, 1))
+        yxMargin = margin
+        if (numpy.all(invertedTransform == numpy.identity(2)) and 
+                numpy.all(offset == numpy.round(offset))):
+            # Whole-pixel shift, so no interpolation.
+            yxMargin = 0
+        for axisPositions in positions:
+            ranges.append((axisPositions.min(), axisPositions.max(), yxMargin))
+        block = []
+        for size, (low, high, axisMargin) in zip(shape, ranges):
+            low = max(0, int(numpy.floor(low)) - axisMargin)
+            high = min(size, int(numpy.ceil(high)) + axisMargin + 1)
+            if low >= high:
+                return None
+            block.append(slice(low, high))
+        return tuple(block)
+
+
+    ## Shift a 3D ZYX array along Z, interpolating with splines of the given
+    # order, as map_coordinates would.
+    # \param fillValue Value for slices that map to outside the input.
+    # \param output Array to write the result into; it may have a different
+    #        number of slices from the input.
+    # \param numThreads Number of threads to spread the work over.
+    # \return The set of indices of the output slices that aren't just 
+    #         fillValue.
+    def shiftVolumeZ(self, inData, dz, order, fillValue, output, 
+            numThreads = 1):
+        numSlices = inData.shape[0]
+        # Output slice i comes from input position i + start + fraction.
+        start = int(numpy.floor(-dz))
+        fraction = -dz - start
+        if not fraction:
+            offsets = numpy.array([0])
+            weights = numpy.array([1.0])
+        else:
+            # Every output slice is the same weighted sum of nearby input 
+            # slices; work out the weights by interpolating an impulse.
+            offsets = numpy.arange(-order, order + 2)
+            impulse = numpy.zeros(4 * order + 5)
+            center = len(impulse) // 2
+            impulse[center] = 1
+            weights = scipy.ndimage.map_coordinates(impulse, 
+                    [center + fraction - offsets], 
+                    order = order, prefilter = False)
+            offsets = offsets[weights != 0]
+            weights = weights[weights != 0]
+            if order > 1:
+                # Prefilter along Z, splitting the volume into blocks of 
+                # rows for the threads.
+                source = inData
+                inData = numpy.empty(source.shape, numpy.float32)
+                def filterRows(rows):
+                    for row in rows:
+                        scipy.ndimage.spline_filter1d(source[:, row], order,
+                                axis = 0, output = inData[:, row])
+                rowBlocks = [slice(i, i + ROWS_PER_BLOCK) 
+                        for i in xrange(0, source.shape[1], ROWS_PER_BLOCK)]
+                runInThreads(filterRows, rowBlocks, numThreads)
+        validSlices = set([i for i in xrange(len(output)) 
+                if 0 <= i + start + fraction <= numSlices - 1])
+        def shiftSlices(indices):
+            for i in indices:
+                if i not in validSlices:
+                    output[i] = fillValue
+                    continue
+                if len(weights) == 1:
+                    output[i] = inData[i + start + offsets[0]]
+                    continue
+                total = numpy.zeros(inData.shape[1:])
+                for offset, weight in zip(offsets, weights):
+                    # Mirror at the edges, as the spline interpolation does.
+                    index = 0
+                    period = 2 * (numSlices - 1)
+                    if period:
+                        index = abs(i + start + offset) % period
+                        index = min(index, period - index)
+                    total += weight * inData[index]
+                output[i] = total
+        runInThreads(shiftSlices, range(len(output)), numThreads)
+        return validSlices
+
+
+    ## Generate a 4D transformation matrix based on self.alignParams (or the
+    # given alignment parameters) for each wavelength.
+    def getTransformationMatrices(self, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams
         result = []
         for wavelength in xrange(self.numWavelengths):
-            dx, dy, dz, angle, zoom = self.alignParams[wavelength]
+            dx, dy, dz, angle, zoom = alignParams[wavelength]
             angle = angle * numpy.pi / 180.0
             cosTheta = numpy.cos(angle)
             sinTheta = numpy.sin(angle)
@@ -428,6 +950,28 @@ class DataDoc:
         return result
 
 
+    ## Classify each wavelength's transformation by how cheaply it can be 
+    # applied: TRANSFORM_IDENTITY if it does nothing, TRANSFORM_INTEGER if
+    # it only shifts by whole pixels, TRANSFORM_TRANSLATION if it only 
+    # shifts, and TRANSFORM_AFFINE if it also rotates or zooms. Uses 
+    # self.alignParams, or the given alignment parameters.
+    def getTransformClasses(self, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams
+        result = []
+        for dx, dy, dz, angle, zoom in alignParams:
+            shifts = numpy.array([dx, dy, dz])
+            if angle != 0 or zoom != 1:
+                result.append(TRANSFORM_AFFINE)
+            elif not numpy.any(shifts):
+                result.append(TRANSFORM_IDENTITY)
+            elif numpy.all(shifts == numpy.round(shifts)):
+                result.append(TRANSFORM_INTEGER)
+            else:
+                result.append(TRANSFORM_TRANSLATION)
+        return result
+
+
     ## Return true if there is any Z motion in any wavelength's alignment
     # parameters.
     def hasZMotion(self):
@@ -464,13 +1008,17 @@ class DataDoc:
     #  TODO 1 - refactor alignAndCrop so it uses this (duplicate) code
     #  TODO 2 - optionally create & return new DataDoc object(s)?
     def saveSelection(self, wavelengths = [], timepoints = [],                   
-            savePath = None):
+            savePath = None, numWorkers = 1, outputDtype = None):
         """
         Save a wavelength=channel and/or timepoint=frame selection.
         Basically a duplicate of parts of the alignAndCrop method below,
         which should now be refactored to use this method instead.
         Note that a new MRC object is created in the process.
+        numWorkers > 1 reads the volumes in that many processes.
+        outputDtype is the datatype of the result; by default it is the 
+        same as the input when saving, and float32 otherwise.
         """
+        outputDtype = self.getExportDtype(outputDtype, savePath)
         if not wavelengths:
             wavelengths = range(self.size[0])
         if not timepoints:
@@ -489,14 +1037,12 @@ class DataDoc:
         newHeader.next = 0
         # Ordering of data in the file; 2 means z/w/t
         newHeader.ImgSequence = 2
-        newHeader.PixelType = Mrc.dtype2MrcMode(numpy.float32)
+        newHeader.PixelType = Mrc.dtype2MrcMode(outputDtype)
 
         if not savePath:
-            outputArray = numpy.empty(newShape, numpy.float32)
+            outputArray = numpy.empty(newShape, outputDtype)
         else:
-            if self.filePath == savePath:
-                # \todo Why do we do this?
-                del self.image.Mrc
+            outputPath = self.getOutputPath(savePath)
 
             # update wavelength info to ensure it remains correct
             #  (we could be re-ordering here)
@@ -504,35 +1050,60 @@ class DataDoc:
                 trueWavelength = self.imageHeader.wave[wavelength]
                 newHeader.wave[waveIndex] = trueWavelength
 
-            # Write out the header.
-            outputFile = file(savePath, 'wb')
-            outputFile.write(newHeader._array.tostring())
+            # Create the file; the header is written when it's closed.
+            outputFile = Mrc.MrcWriter(outputPath, newHeader)
 
+        tasks = []
+        positions = []
         for timepoint in timepoints:
             for waveIndex, wavelength in enumerate(wavelengths):
-                volume = self.imageArray[wavelength][timepoint]
-                
+                tasks.append((wavelength, timepoint, False, None, 
+                        outputDtype))
+                positions.append((timepoint, waveIndex))
+        try:
+            volumes = self.iterExportVolumes(tasks, numWorkers)
+            for (timepoint, waveIndex), volume in itertools.izip(positions, 
+                    volumes):
                 if not savePath:
                     outputArray[timepoint, waveIndex] = volume
                 else:
                     # Write to the file.
-                    for i, zSlice in enumerate(volume):
-                        outputFile.write(zSlice)
+                    outputFile.writeSections(volume)
+            if savePath:
+                outputFile.close()
+        except:
+            if savePath:
+                # Don't leave the file open, or a partial file behind.
+                outputFile.abort()
+            raise
 
         if not savePath:
             # Reorder to WTZYX since that's what the user expects.
             return outputArray.transpose([1, 0, 2, 3, 4])
-        else:
-            outputFile.close()
+        elif outputPath != savePath:
+            os.rename(outputPath, savePath)
 
 
     def alignAndCrop(self, wavelengths = [], timepoints = [], 
-            savePath = None):
+            savePath = None, numWorkers = 1, outputDtype = None, 
+            memoryBudget = None, alignParams = None):
         """
         Align and Crop the chosen channels/timepoints according to 
         values already set in this DataDoc, and save the new MRC 
-        file result.
+        file result. numWorkers > 1 transforms the volumes in that 
+        many processes; the result is the same. outputDtype is the 
+        datatype of the result; by default it is the same as the 
+        input when saving, and float32 otherwise. If memoryBudget is 
+        given, volumes are instead aligned in this process in XY 
+        tiles that each need at most that many bytes, and written 
+        straight to the file, for volumes too big to fit in memory.
+        alignParams, if given, are used instead of the DataDoc's own 
+        alignment parameters.
         """
+        if alignParams is None:
+            # Don't let changes part way through mix parameters.
+            alignParams = self.alignParams.copy()
+        outputDtype = self.getExportDtype(outputDtype, savePath)
         if not wavelengths:
             wavelengths = range(self.size[0])
         if not timepoints:
@@ -556,50 +1127,303 @@ class DataDoc:
         newHeader.next = 0
         # Ordering of data in the file; 2 means z/w/t
         newHeader.ImgSequence = 2
-        newHeader.PixelType = Mrc.dtype2MrcMode(numpy.float32)
+        newHeader.PixelType = Mrc.dtype2MrcMode(outputDtype)
 
         if not savePath:
-            outputArray = numpy.empty(croppedShape, numpy.float32)
+            outputArray = numpy.empty(croppedShape, outputDtype)
         else:
-            if self.filePath == savePath:
-                # \todo Why do we do this?
-                del self.image.Mrc
-
-            # Write out the header.
-            outputFile = file(savePath, 'wb')
-            outputFile.write(newHeader._array.tostring())
-
-        # Slices to use to crop out the 3D volume we want to use for each
-        # wave-timepoint pair.
-        volumeSlices = []
-        for min, max in zip(self.cropMin[2:], self.cropMax[2:]):
-            volumeSlices.append(slice(min, max))
+            outputPath = self.getOutputPath(savePath)
+
+            # Create the file; the header is written when it's closed.
+            outputFile = Mrc.MrcWriter(outputPath, newHeader)
+
+        tasks = []
+        positions = []
         for timepoint in timepoints:
             for waveIndex, wavelength in enumerate(wavelengths):
-                volume = self.imageArray[wavelength][timepoint]
-                dx, dy, dz, angle, zoom = self.alignParams[wavelength]
-                if dz and self.size[2] == 1:
-                    dz = 0  # in 2D files Z translation blanks out the slice!
-                if dx or dy or dz or angle or zoom != 1:
-                    # Transform the volume.
-                    volume2 = self.transformArray(
-                            volume, dx, dy, dz, angle, zoom
-                    )
-                else:
-                    volume2 = volume.copy()  # no transform
-                # Crop to the desired shape.
-                volume2 = volume2[volumeSlices].astype(numpy.float32)
-                if not savePath:
-                    outputArray[timepoint, waveIndex] = volume2
-                else:
-                    # Write to the file.
-                    for i, zSlice in enumerate(volume2):
-                        outputFile.write(zSlice)
+                tasks.append((wavelength, timepoint, True, 
+                        self.getVolumeMin(wavelength, timepoint), 
+                        outputDtype))
+                positions.append((timepoint, waveIndex))
+        try:
+            if memoryBudget is not None:
+                # Tile sizes only depend on the wavelength's transform.
+                tiles = dict([(wavelength, self.getExportTiles(wavelength, 
+                        outputDtype, memoryBudget, alignParams)) 
+                        for wavelength in wavelengths])
+                for (timepoint, waveIndex), task in itertools.izip(positions, 
+                        tasks):
+                    wavelength, fillValue = task[0], task[3]
+                    if not savePath:
+                        output = outputArray[timepoint, waveIndex]
+                    else:
+                        output = outputFile.mapSections(croppedShape[2])
+                    self.writeExportTiles(wavelength, timepoint, fillValue, 
+                            outputDtype, output, tiles[wavelength], 
+                            alignParams)
+            else:
+                volumes = self.iterExportVolumes(tasks, numWorkers, 
+                        alignParams)
+                for (timepoint, waveIndex), volume2 in itertools.izip(
+                        positions, volumes):
+                    if not savePath:
+                        outputArray[timepoint, waveIndex] = volume2
+                    else:
+                        # Write to the file.
+                        outputFile.writeSections(volume2)
+            if savePath:
+                outputFile.close()
+        except:
+            if savePath:
+                # Don't leave the file open, or a partial file behind.
+                outputFile.abort()
+            raise
         if not savePath:
             # Reorder to WTZYX since that's what the user expects.
             return outputArray.transpose([1, 0, 2, 3, 4])
+        elif outputPath != savePath:
+            os.rename(outputPath, savePath)
+
+    ## Generate one volume of an export.
+    # \param transform If true, align and crop the volume as for 
+    #        alignAndCrop; otherwise return it as it is in the file.
+    # \param fillValue Minimum of the volume, if known; see transformArray.
+    # \param dtype Datatype to convert the volume to; see convertVolume. 
+    #        By default aligned volumes are float32, and others are left in
+    #        our datatype.
+    # \param output Optional float32 buffer for the aligned volume.
+    # \param region Tuple of ZYX slices of the part of the aligned volume to
+    #        generate; by default, the whole cropped volume.
+    # \param alignParams Alignment parameters to use; by default, ours.
+    def makeExportVolume(self, wavelength, timepoint, transform, 
+            fillValue = None, dtype = None, output = None, region = None,
+            alignParams = None):
+        if not transform:
+            volume = numpy.asarray(self.imageArray[wavelength, timepoint])
+            if dtype is None:
+                return volume
+            return self.convertVolume(volume, dtype)
+        # Slices to use to crop out the 3D volume we want.
+        volumeSlices = region
+        if volumeSlices is None:
+            volumeSlices = self.getCropSlices()
+        dx, dy, dz, angle, zoom = self.getExportParams(wavelength, 
+                alignParams)
+        if dx or dy or dz or angle or zoom != 1:
+            # Transform just the cropped region of the volume, reading in 
+            # only the part of the file it comes from.
+            volume = self.transformArray(
+                    self.getVolume(wavelength, timepoint), 
+                    dx, dy, dz, angle, zoom, output = output, 
+                    region = volumeSlices, fillValue = fillValue)
         else:
-            outputFile.close()
+            # No transform; just crop.
+            volume = numpy.asarray(
+                    self.imageArray[(wavelength, timepoint) + volumeSlices])
+        if dtype is None:
+            dtype = numpy.float32
+        return self.convertVolume(volume, dtype)
+
+
+    ## Return the ZYX slices that crop the aligned volume.
+    def getCropSlices(self):
+        return tuple([slice(min, max) 
+                for min, max in zip(self.cropMin[2:], self.cropMax[2:])])
+
+
+    ## Return the alignment parameters to export the given wavelength with,
+    # from the given alignment parameters, or by default our own.
+    def getExportParams(self, wavelength, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams
+        dx, dy, dz, angle, zoom = alignParams[wavelength]
+        if dz and self.size[2] == 1:
+            dz = 0  # in 2D files Z translation blanks out the slice!
+        return dx, dy, dz, angle, zoom
+
+
+    ## Align and crop one volume for export as makeExportVolume does, but a
+    # tile at a time, so that only the part of the input each tile comes 
+    # from is read in, and memory use stays within a budget no matter how 
+    # big the volume is.
+    # \param output Array to write the cropped volume into; for a file, a 
+    #        memory map of it, so each tile goes straight to disk.
+    # \param tiles List of regions to generate, as from getExportTiles.
+    # \param alignParams Alignment parameters to use; by default, ours.
+    def writeExportTiles(self, wavelength, timepoint, fillValue, dtype, 
+            output, tiles, alignParams = None):
+        if fillValue is None:
+            fillValue = self.getVolumeMin(wavelength, timepoint)
+        if fillValue is None:
+            # Every tile has to use the same fill value; find it a section
+            # at a time.
+            fillValue = min([self.imageArray[wavelength, timepoint, z].min()
+                    for z in xrange(self.size[2])])
+        cropStart = self.cropMin[2:]
+        for tile in tiles:
+            target = tuple([slice(r.start - start, r.stop - start) 
+                    for r, start in zip(tile, cropStart)])
+            output[target] = self.makeExportVolume(wavelength, timepoint, 
+                    True, fillValue, dtype, region = tile, 
+                    alignParams = alignParams)
+
+
+    ## Split the cropped volume of the given wavelength into tiles along Y
+    # and X, each of which can be aligned and cropped within the given 
+    # memory budget; see writeExportTiles. Tiles are halved along their 
+    # longer side until they fit. 
+    # \param dtype Datatype the volume is exported as.
+    # \param memoryBudget Maximum number of bytes to use for each tile.
+    # \param alignParams Alignment parameters to use; by default, ours.
+    # \return A list of tuples of ZYX slices, one per tile.
+    def getExportTiles(self, wavelength, dtype, memoryBudget, 
+            alignParams = None):
+        crop = self.getCropSlices()
+        tileShape = [crop[1].stop - crop[1].start, 
+                crop[2].stop - crop[2].start]
+        while True:
+            tiles = [(crop[0], slice(y, min(y + tileShape[0], crop[1].stop)),
+                        slice(x, min(x + tileShape[1], crop[2].stop)))
+                    for y in xrange(crop[1].start, crop[1].stop, tileShape[0])
+                    for x in xrange(crop[2].start, crop[2].stop, tileShape[1])]
+            cost = max([self.estimateExportBytes(wavelength, tile, dtype,
+                    alignParams)
+                    for tile in tiles])
+            if cost <= memoryBudget:
+                return tiles
+            axis = int(tileShape[1] > tileShape[0])
+            if tileShape[axis] <= MIN_TILE_SIZE:
+                raise RuntimeError("Can't align %d slices in %d bytes; " % 
+                        (crop[0].stop - crop[0].start, memoryBudget) +
+                        "%d bytes are needed per tile." % cost)
+            tileShape[axis] = max(MIN_TILE_SIZE, (tileShape[axis] + 1) // 2)
+
+
+    ## Estimate the peak number of bytes makeExportVolume uses to generate 
+    # the given region of the aligned volume for the given wavelength: the 
+    # block of input it reads, the float32 copies transformArray makes of 
+    # that, and the result before and after conversion to dtype, using the
+    # given alignment parameters or by default ours.
+    def estimateExportBytes(self, wavelength, region, dtype, 
+            alignParams = None):
+        dx, dy, dz, angle, zoom = self.getExportParams(wavelength, 
+                alignParams)
+        regionShape = [r.stop - r.start for r in region]
+        regionBytes = (numpy.product(regionShape) * 
+                numpy.dtype(dtype).itemsize)
+        inputSize = numpy.dtype(self.dtype).itemsize
+        if not (dx or dy or dz or angle or zoom != 1):
+            # Just cropped.
+            return numpy.product(regionShape) * inputSize + regionBytes
+        invertedTransform, offset = getYXTransform(self.size[3:], 
+                dx, dy, angle, zoom)
+        block = self.getSourceBlock(self.size[2:], invertedTransform, offset,
+                dz, region, 3)
+        if block is None:
+            return regionBytes
+        blockShape = [b.stop - b.start for b in block]
+        sliceBytes = 4 * numpy.product(blockShape[1:])
+        # Input block and its prefiltered copy; the block shifted in Z; 
+        # spline-prefiltered float64 slices, one per thread; and the 
+        # result, as float32 and converted.
+        return (numpy.product(blockShape) * (inputSize + 4) + 
+                regionShape[0] * sliceBytes + 
+                self.numTransformThreads * 2 * sliceBytes + 
+                4 * numpy.product(regionShape) + regionBytes)
+
+
+    ## Convert a volume to the given datatype for export. Conversion to 
+    # integer types rounds to the nearest integer and clips to the range of
+    # the type, since interpolation can overshoot it; integer volumes are 
+    # only clipped, and only if the type can't hold all their values.
+    def convertVolume(self, volume, dtype):
+        dtype = numpy.dtype(dtype)
+        if volume.dtype == dtype:
+            return volume
+        if numpy.issubdtype(dtype, numpy.integer):
+            info = numpy.iinfo(dtype)
+            if not numpy.issubdtype(volume.dtype, numpy.integer):
+                volume = numpy.clip(numpy.rint(volume), info.min, info.max)
+            elif not numpy.can_cast(volume.dtype, dtype):
+                # Clip to the range both types can hold, so the limits 
+                # don't overflow the volume's own type.
+                sourceInfo = numpy.iinfo(volume.dtype)
+                volume = numpy.clip(volume, max(info.min, sourceInfo.min),
+                        min(info.max, sourceInfo.max))
+        return volume.astype(dtype)
+
+
+    ## Generate the volumes for an export, in order, either in this process 
+    # or in a pool of worker processes that each open our file themselves.
+    # Since the volumes are independent, this is an easy way to use every
+    # core on the machine.
+    # \param tasks List of argument tuples for makeExportVolume.
+    # \param numWorkers Number of worker processes to use; if 1, everything
+    #        is done in this process.
+    # \param alignParams Alignment parameters to use; by default, a copy of
+    #        ours.
+    def iterExportVolumes(self, tasks, numWorkers = 1, alignParams = None):
+        if alignParams is None:
+            alignParams = self.alignParams.copy()
+        if numWorkers <= 1:
+            # Reuse one buffer for all aligned volumes.
+            shape = tuple(numpy.array(self.cropMax[2:]) - 
+                    numpy.array(self.cropMin[2:]))
+            buffer = numpy.empty(shape, numpy.float32)
+            for task in tasks:
+                yield self.makeExportVolume(*task, output = buffer, 
+                        alignParams = alignParams)
+            return
+        pool = multiprocessing.Pool(numWorkers, initExportWorker, 
+                (self.filePath, alignParams, self.cropMin, self.cropMax))
+        try:
+            # imap hands the results back in the order of the tasks, no 
+            # matter which worker finishes first.
+            for volume in pool.imap(makeExportVolume, tasks):
+                yield volume
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    ## Return the datatype an export should produce.
+    # \param outputDtype Datatype requested by the caller, if any.
+    # \param savePath Where the export is saved to, if anywhere. Saved files
+    #        default to our datatype, so they're no bigger than the input; 
+    #        in-memory results default to float32 for further processing.
+    def getExportDtype(self, outputDtype, savePath):
+        if outputDtype is not None:
+            return numpy.dtype(outputDtype)
+        if savePath:
+            return numpy.dtype(self.dtype)
+        return numpy.dtype(numpy.float32)
+
+
+    ## Return the minimum of the given volume if we know it without reading
+    # the volume, or None otherwise.
+    def getVolumeMin(self, wavelength, timepoint):
+        volumeRange = self.stats.getVolumeRange(wavelength, timepoint)
+        if volumeRange is not None:
+            return volumeRange[0]
+        return None
+
+
+    ## Return the path to write output destined for savePath to. Our pixel
+    # data is a view onto our own file, so if we are asked to overwrite that
+    # file we must not truncate it while we are still reading from it;
+    # instead we write to a temporary file alongside it, which the caller
+    # renames over savePath once writing is done. Windows won't replace a 
+    # file that is mapped into memory, so there we refuse up front rather 
+    # than fail once the whole export has been written.
+    def getOutputPath(self, savePath):
+        if os.path.abspath(savePath) == self.filePath:
+            if os.name == 'nt':
+                raise RuntimeError(("Can't overwrite %s while it is " +
+                        "open; please save to a different file.") % savePath)
+            return savePath + '.tmp'
+        return savePath
+
 
     def getExtendedHeaderIndex(self, timepoint, wavelength, zIndex):
         sequence = self.imageHeader.ImgSequence
@@ -687,6 +1511,78 @@ class DataDoc:
 
 
 ### module helper / non-instance methods
+
+## DataDoc for the file being exported, in export worker processes; see 
+# DataDoc.iterExportVolumes.
+exportDoc = None
+
+
+## Set up an export worker process: open the file being exported, and copy
+# over the parameters the export depends on.
+def initExportWorker(path, alignParams, cropMin, cropMax):
+    global exportDoc
+    exportDoc = DataDoc(path, refineStats = False)
+    # The processes already keep every core busy.
+    exportDoc.numTransformThreads = 1
+    exportDoc.alignParams = alignParams
+    exportDoc.cropMin = cropMin
+    exportDoc.cropMax = cropMax
+
+
+## Generate one volume of an export in a worker process.
+# \param task Tuple of arguments for DataDoc.makeExportVolume.
+def makeExportVolume(task):
+    return exportDoc.makeExportVolume(*task)
+
+
+## Call function with a share of the given list of items in each of up to 
+# numThreads threads (one of them the calling thread), and wait for them all
+# to finish. Any exception raised in a thread is re-raised here.
+def runInThreads(function, items, numThreads):
+    chunks = [items[i::numThreads] for i in xrange(max(1, numThreads))]
+    chunks = [chunk for chunk in chunks if chunk]
+    if len(chunks) <= 1:
+        function(items)
+        return
+    errors = []
+    def run(chunk):
+        try:
+            function(chunk)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target = run, args = (chunk,)) 
+            for chunk in chunks[1:]]
+    for thread in threads:
+        thread.start()
+    run(chunks[0])
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+## Return the inverted 2x2 matrix and the offset that map output YX 
+# coordinates to input ones for DataDoc.transformArray, as for 
+# scipy.ndimage.affine_transform, so that planes can be transformed the same
+# way elsewhere.
+# \param yxShape YX shape of the data being transformed.
+def getYXTransform(yxShape, dx, dy, angle, zoom):
+    # Input angle is in degrees, but scipy's transformations expect angles
+    # in radians.
+    angle = angle * numpy.pi / 180
+    cosTheta = numpy.cos(-angle)
+    sinTheta = numpy.sin(-angle)
+    affineTransform = zoom * numpy.array(
+            [[cosTheta, sinTheta], [-sinTheta, cosTheta]])
+
+    invertedTransform = numpy.linalg.inv(affineTransform)
+    yxCenter = numpy.array(yxShape) / 2.0
+    # Rotate and zoom about the center, then shift.
+    offset = (-numpy.dot(invertedTransform, yxCenter + [dy, dx]) + 
+            yxCenter)
+    return invertedTransform, offset
+
+
 def saveNewMrc(mrc_path, arr, n_tzcyx, cal_xyz, wavelengths=None):
     """
     Write a new Mrc file using numpy ndarray 'arr' and tuples of
@@ -710,15 +1606,16 @@ def saveNewMrc(mrc_path, arr, n_tzcyx, cal_xyz, wavelengths=None):
     hdr.d = cal_xyz
     hdr.wave = wavelengths
 
-    # write header & slices
-    f_out = file(mrc_path, 'wb')
-    f_out.write(hdr._array.tostring())
-    for t in range(nt):
-        for c in range(nc):
-            for z in range(nz):
-                arr_yx_yinverted = arr[t, c, z, ::-1, :]
-                f_out.write(arr_yx_yinverted.copy(order='C'))
-
-    f_out.close()
+    # write slices (a Z stack at a time) & header
+    writer = Mrc.MrcWriter(mrc_path, hdr)
+    try:
+        for t in range(nt):
+            for c in range(nc):
+                writer.writeSections(arr[t, c, :, ::-1, :])
+        writer.close()
+    except:
+        # Don't leave the file open, or a partial file behind.
+        writer.abort()
+        raise
     
     return DataDoc(mrc_path)
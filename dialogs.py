@@ -78,6 +78,17 @@ class BatchDialog(wx.Dialog):
         self.shouldAlign.SetValue(True)
         rowSizer.Add(self.shouldAlign)
         mainSizer.Add(rowSizer, 0, wx.ALIGN_CENTRE | wx.BOTTOM, 5)
+
+        rowSizer = wx.BoxSizer(wx.HORIZONTAL)
+        rowSizer.Add(wx.StaticText(self, -1, "Save as: "), 0, 
+                wx.ALIGN_CENTER_VERTICAL)
+        ## Choice of datatype to save the files as; the first option keeps
+        # each file's own datatype.
+        self.dtypeChoice = wx.Choice(self, -1, 
+                choices = ["same as input"] + datadoc.EXPORT_DTYPES.keys())
+        self.dtypeChoice.SetSelection(0)
+        rowSizer.Add(self.dtypeChoice)
+        mainSizer.Add(rowSizer, 0, wx.ALIGN_CENTRE | wx.BOTTOM, 5)
         
         rowSizer = wx.BoxSizer(wx.HORIZONTAL)
         cancelButton = wx.Button(self, wx.ID_CANCEL, "Cancel")
@@ -112,6 +123,10 @@ class BatchDialog(wx.Dialog):
             return
 
         files = openDialog.GetPaths()
+        outputDtype = None
+        if self.dtypeChoice.GetSelection() > 0:
+            outputDtype = datadoc.EXPORT_DTYPES[
+                    self.dtypeChoice.GetStringSelection()]
 
         progress = wx.ProgressDialog(parent = self,
                 title = "Aligning and cropping files",
@@ -155,7 +170,14 @@ class BatchDialog(wx.Dialog):
             # TODO: always use .dv fext?
             targetFilename = froot + tag + fext
             print targetFilename
-            doc.alignAndCrop(savePath = targetFilename)
+            try:
+                doc.alignAndCrop(savePath = targetFilename, 
+                        outputDtype = outputDtype)
+            except RuntimeError, e:
+                # E.g. the file is open and can't be replaced; carry on 
+                # with the others.
+                wx.MessageDialog(self, str(e), "Couldn't save file",
+                        wx.ICON_ERROR | wx.OK | wx.STAY_ON_TOP).ShowModal()
         progress.Update(len(files), "All done!")
 
         self.Hide()
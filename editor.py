@@ -68,23 +68,29 @@ def resultName(dataDoc, operation):
     return os.path.join(dirname, basename + "_" + RESULT_TAG[operation])
 
 
-def autoAlign(dataDoc, refChannel=0, logfileFullpath=None):
+def autoAlign(dataDoc, refChannel=0, logfileFullpath=None, numWorkers=1,
+              outputDtype=None, memoryBudget=None, method='simplex',
+              useProcesses=False):
     """
-    Find alignment parameters relative to a reference channel,
-    print alignment progress to logfile, save alignment parameters
-    and aligned image.
+    Find alignment parameters relative to a reference channel (using
+    one of align.ALIGN_METHODS, aligning each channel in its own process
+    if useProcesses), print alignment progress to logfile,
+    save alignment parameters and aligned image (using numWorkers
+    processes, as outputDtype, within memoryBudget bytes if given).
     """
     if logfileFullpath is None:
         logfileFullpath = resultName(dataDoc, 'autoAlign')
     fh = open(logfileFullpath, 'w')
     stdout = sys.stdout
     sys.stdout = fh  # redirect log from stdout to file
-    aligner = align.AutoAligner(dataDoc, refChannel)
+    aligner = align.AutoAligner(dataDoc, refChannel, method, useProcesses)
     aligner.run()  # updates dataDoc.alignParams
     sys.stdout = stdout
     fh.close()
     saveAlignParameters(dataDoc)
-    alignAndCrop(dataDoc)  # uses dataDoc.alignParams & .cropMin, .cropMax
+    # uses dataDoc.alignParams & .cropMin, .cropMax
+    alignAndCrop(dataDoc, numWorkers=numWorkers, outputDtype=outputDtype,
+                 memoryBudget=memoryBudget)
 
 
 def saveAlignParameters(dataDoc, fullpath=None):
@@ -144,14 +150,19 @@ def loadAlignParameters(alignParamsFullpath, dataDoc):
     dataDoc.cropMax.insert(0, dataDoc.numWavelengths) # all channels
 
 
-def alignAndCrop(dataDoc, fullpath=None):
+def alignAndCrop(dataDoc, fullpath=None, numWorkers=1, outputDtype=None,
+                 memoryBudget=None):
     """
     Align and crop a DataDoc using its align and crop params, write Mrc file,
-    return path to new DataDoc.
+    return path to new DataDoc. Use numWorkers processes to transform, and
+    save as outputDtype (by default, the same datatype as the input). If
+    memoryBudget is given, transform volumes in tiles that need at most
+    that many bytes each, for volumes too large to fit in memory.
     """
     if fullpath is None:
         fullpath = resultName(dataDoc, 'alignAndCrop')
-    dataDoc.alignAndCrop(savePath=fullpath)
+    dataDoc.alignAndCrop(savePath=fullpath, numWorkers=numWorkers,
+                         outputDtype=outputDtype, memoryBudget=memoryBudget)
     return fullpath
 
 
@@ -274,9 +285,25 @@ if __name__ == '__main__':
              "reorder channels 0,1,..N to the new order given, e.g. 3,2,1"),
             ('-i', '--info', "store_true",
              "display header info in the Mrc file(s)")]
+    # options that modify the actions above, rather than being actions
+    OPTIONS = [('-w', '--workers', "store", int,
+                "number of processes to use when saving aligned files"),
+               ('-d', '--dtype', "store", str,
+                "datatype to save aligned files as, one of: " +
+                ", ".join(datadoc.EXPORT_DTYPES.keys()) +
+                " (default: same as input)"),
+               ('-mb', '--memory', "store", int,
+                "align volumes in tiles using at most this many megabytes "
+                "each, for volumes too large to fit in memory"),
+               ('-am', '--alignMethod', "store", str,
+                "method to auto-align with, one of: " +
+                ", ".join(sorted(align.ALIGN_METHODS.keys())) +
+                " (default: simplex)"),
+               ('-ap', '--alignProcesses', "store_true",
+                "auto-align each channel in its own process")]
 
     parser = argparse.ArgumentParser()
-    for arg in ARGS:
+    for arg in ARGS + OPTIONS:
         if arg[2] == "store_true":
             parser.add_argument(*arg[0:2], action=arg[2], help=arg[3])
         else:
@@ -297,11 +324,28 @@ if __name__ == '__main__':
         sys.exit()
 
     files = args.files.split(",")
+    numWorkers = args.workers or 1
+    outputDtype = None
+    if args.dtype is not None:
+        if args.dtype not in datadoc.EXPORT_DTYPES:
+            parser.print_help()
+            print "\nExiting: unknown datatype %s." % args.dtype
+            sys.exit()
+        outputDtype = datadoc.EXPORT_DTYPES[args.dtype]
+    alignMethod = args.alignMethod or 'simplex'
+    if alignMethod not in align.ALIGN_METHODS:
+        parser.print_help()
+        print "\nExiting: unknown alignment method %s." % alignMethod
+        sys.exit()
+    memoryBudget = None
+    if args.memory is not None:
+        memoryBudget = args.memory * 1024 * 1024
     if isinstance(args.batchAlignAndCrop, str):
         for filepath in files:
             dataDoc = datadoc.DataDoc(files[0])
             loadAlignParameters(args.batchAlignAndCrop, dataDoc)
-            alignAndCrop(dataDoc)
+            alignAndCrop(dataDoc, numWorkers=numWorkers,
+                         outputDtype=outputDtype, memoryBudget=memoryBudget)
     if args.merge:
         print("TODO: merge single-channel images into a single new image")
 
@@ -312,7 +356,9 @@ if __name__ == '__main__':
     else:
         dataDoc = datadoc.DataDoc(files[0])
     if isinstance(args.align, int):
-        autoAlign(dataDoc, args.align)
+        autoAlign(dataDoc, args.align, numWorkers=numWorkers,
+                  outputDtype=outputDtype, memoryBudget=memoryBudget,
+                  method=alignMethod, useProcesses=args.alignProcesses)
     if args.project:
         project(dataDoc)
     if args.splitChannels:
@@ -44,7 +44,10 @@ class HistogramCanvas(wx.glcanvas.GLCanvas):
     #        scale.
     # \param image Image array we provide a histogram for.
     # \param numBins How many bins to use when generating the histogram.
-    def __init__(self, parent, scaleCallback, infoCallback, image, color, size):
+    # \param histogram Precomputed (bin counts, bin edges) to use instead of
+    #        binning image ourselves, in which case image may be None.
+    def __init__(self, parent, scaleCallback, infoCallback, image, color, size,
+            histogram = None):
         wx.glcanvas.GLCanvas.__init__(self, parent, size = size)
         self.scaleCallback = scaleCallback
         self.infoCallback = infoCallback
@@ -67,14 +70,20 @@ class HistogramCanvas(wx.glcanvas.GLCanvas):
         ## OpenGL context
         self.context = wx.glcanvas.GLContext(self)
 
-        self.updateImage(image)
+        self.updateImage(image, histogram)
 
         self.Bind(wx.EVT_PAINT, self.onPaint)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.onMouse)
     
 
-    ## Recalculate our bins and min/max values, based on the provided image.
-    def updateImage(self, image):
+    ## Recalculate our bins and min/max values, based on the provided image,
+    # or take them from a precomputed (bin counts, bin edges) histogram.
+    def updateImage(self, image, histogram = None):
+        if histogram is not None:
+            self.binSizes, self.binEdges = histogram
+            self.minVal = self.binEdges[0]
+            self.maxVal = self.binEdges[-1]
+            return
         self.binSizes, self.binEdges = numpy.histogram(image, self.numBins)
         self.minVal = image.min()
         self.maxVal = image.max()
@@ -88,8 +97,14 @@ class HistogramCanvas(wx.glcanvas.GLCanvas):
     ## Adjust our black/whitepoints to the given image, which is a subset
     # of our overall data.
     def autoFitToImage(self, image):
-        self.minVal = image.min()
-        self.maxVal = image.max()
+        self.autoFitToRange(image.min(), image.max())
+
+
+    ## As autoFitToImage, but with the min and max of the subset already
+    # known.
+    def autoFitToRange(self, minVal, maxVal):
+        self.minVal = minVal
+        self.maxVal = maxVal
         self.Refresh()
 
 
@@ -133,7 +148,8 @@ class HistogramCanvas(wx.glcanvas.GLCanvas):
         # Draw a quad for each bin
         glBegin(GL_QUADS)
         glColor3f(0, 0, 0)
-        binWidth = self.width / float(self.numBins)
+        # Precomputed histograms needn't have self.numBins bins.
+        binWidth = self.width / float(len(self.binSizes))
         maxVal = max(self.binSizes)
         for i, size in enumerate(self.binSizes):
             if size:
@@ -208,8 +224,9 @@ class HistogramPanel(wx.Panel):
     ## \param scaleCallback Function to call when the histogram scaling is 
     #         changed.
     # \param helpCallback Function to call to set help text.
+    # \param histogram Optional precomputed histogram; see HistogramCanvas.
     def __init__(self, parent, scaleCallback, helpCallback, wavelength, image, 
-            color, size):
+            color, size, histogram = None):
         wx.Panel.__init__(self, parent, size = size, style = wx.BORDER_SUNKEN)
         ## Wavelength we are controlling.
         self.wavelength = wavelength
@@ -219,7 +236,7 @@ class HistogramPanel(wx.Panel):
         sizer = wx.BoxSizer(wx.VERTICAL)
         ## Canvas for drawing the histogram
         self.canvas = HistogramCanvas(self, modScaleCallback, self.onInfo, 
-                image, color, size)
+                image, color, size, histogram)
         self.canvas.SetMinSize(size)
         sizer.Add(self.canvas, 1, wx.EXPAND)
 
@@ -245,6 +262,10 @@ class HistogramPanel(wx.Panel):
         self.canvas.autoFitToImage(image)
 
 
+    def autoFitToRange(self, minVal, maxVal):
+        self.canvas.autoFitToRange(minVal, maxVal)
+
+
     ## Retrieve the min/max points (below min is 0, above max is 1).
     def getMinMax(self):
         return self.canvas.getMinMax()
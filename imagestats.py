@@ -0,0 +1,353 @@
+# Copyright 2015, Graeme Ball
+# Copyright 2012, The Regents of University of California
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import numpy
+import os
+import threading
+
+## Maximum number of XY sections per wavelength to read when estimating
+# statistics.
+NUM_SAMPLE_SECTIONS = 16
+
+## Approximate number of rows to read from each sampled section.
+NUM_SAMPLE_ROWS = 64
+
+## Approximate number of bytes of pixel data to read at a time when computing
+# exact statistics.
+CHUNK_BYTES = 16 * 1024 * 1024
+
+## Names of the statistics we compute.
+STAT_NAMES = ['min', 'max', 'mean', 'std']
+
+## Names of the per-section statistics we compute in the exact pass.
+SECTION_STAT_NAMES = ['min', 'max', 'mean', 'var']
+
+## Number of bins in the coarse per-(wavelength, timepoint) histograms.
+NUM_HISTOGRAM_BINS = 256
+
+## Extension appended to a data file's name to get the name of the sidecar
+# file its statistics are cached in.
+SIDECAR_EXTENSION = '.omxstats'
+
+
+## This class computes summary statistics (min, max, mean, and standard 
+# deviation) of each wavelength of a WTZYX pixel array. A fast estimate is 
+# made from a stratified sample of XY sections as soon as the object is 
+# created; exact values can be computed in a single chunked pass over the 
+# data, optionally in a background thread, after which they replace the 
+# estimate. 
+# The exact pass also records per-section statistics and a coarse histogram
+# of each (wavelength, timepoint) volume. If the array comes from a file, 
+# these are saved to a sidecar file next to it, and loaded from there (with
+# no pixel scan at all) the next time the same file is opened.
+class ImageStats:
+    ## \param imageArray 5D array of pixel data, in WTZYX order. This is 
+    #        normally a view onto a memory-mapped file, so we take care to 
+    #        only read the parts of it we need.
+    # \param filePath Path to the file the data comes from, if any; used to
+    #        find the sidecar file.
+    # \param header Raw bytes of the file's header, used to make sure the
+    #        sidecar file matches the data.
+    def __init__(self, imageArray, filePath = None, header = ''):
+        self.imageArray = imageArray
+        ## Lock around self.stats, which the background thread replaces.
+        self.lock = threading.Lock()
+        ## Per-section statistics from the exact pass, as (W, T, Z) arrays
+        # keyed by the names in SECTION_STAT_NAMES; None until the exact pass
+        # has run.
+        self.sectionStats = None
+        ## Histogram bin counts for each (wavelength, timepoint) volume, as 
+        # a (W, T, NUM_HISTOGRAM_BINS) array; None until the exact pass has
+        # run.
+        self.histograms = None
+        ## Lower and upper edge of the histogram bins of each 
+        # (wavelength, timepoint) volume, as a (W, T, 2) array.
+        self.histogramRanges = None
+        ## Thread computing exact statistics, if any.
+        self.refineThread = None
+        ## Path to the sidecar file, if any.
+        self.sidecarPath = None
+        ## Key identifying the file contents the sidecar file must match.
+        self.sidecarKey = None
+        if filePath is not None:
+            self.sidecarPath = filePath + SIDECAR_EXTENSION
+            self.sidecarKey = makeSidecarKey(filePath, header)
+
+        ## Whether or not self.stats holds exact values.
+        self.isExact = self.loadSidecar()
+        if self.isExact:
+            ## Maps each name in STAT_NAMES to a list of values, one per 
+            # wavelength.
+            self.stats = self.summarize(self.sectionStats)
+        else:
+            self.stats = self.estimate()
+
+
+    ## Estimate statistics for each wavelength from a stratified sample of
+    # sections: the (time, Z) sections are split into equally-sized strata 
+    # and one section is drawn from each, and only every Nth row of each 
+    # drawn section is read. Min/max are therefore only bounds on the true
+    # values.
+    def estimate(self):
+        numWavelengths, numTimepoints, numZ, numY = self.imageArray.shape[:4]
+        numSections = numTimepoints * numZ
+        numSamples = min(NUM_SAMPLE_SECTIONS, numSections)
+        bounds = numpy.linspace(0, numSections, numSamples + 1).astype(int)
+        # Seed the generator so the same file always gives the same estimate.
+        generator = numpy.random.RandomState(0)
+        indices = [generator.randint(low, high) 
+                for low, high in zip(bounds[:-1], bounds[1:])]
+        rowStep = max(1, numY // NUM_SAMPLE_ROWS)
+
+        result = dict([(name, []) for name in STAT_NAMES])
+        for wavelength in xrange(numWavelengths):
+            samples = numpy.array([
+                    self.imageArray[wavelength, i // numZ, i % numZ, ::rowStep]
+                    for i in indices])
+            result['min'].append(samples.min())
+            result['max'].append(samples.max())
+            result['mean'].append(samples.mean(dtype = numpy.float64))
+            result['std'].append(samples.std(dtype = numpy.float64))
+        return result
+
+
+    ## Compute exact statistics for each wavelength in one pass over the 
+    # data, reading a few sections at a time. Also records min, max, mean, 
+    # and variance for every individual section in self.sectionStats, and
+    # a histogram of every (wavelength, timepoint) volume in 
+    # self.histograms, and saves them to the sidecar file.
+    # \return The same mapping as self.estimate().
+    def computeExact(self):
+        numWavelengths, numTimepoints, numZ, numY, numX = self.imageArray.shape
+        sectionBytes = numY * numX * self.imageArray.dtype.itemsize
+        chunkSize = max(1, CHUNK_BYTES // sectionBytes)
+        sectionStats = {}
+        for name in SECTION_STAT_NAMES:
+            sectionStats[name] = numpy.zeros(
+                    (numWavelengths, numTimepoints, numZ), numpy.float64)
+        histograms = numpy.zeros(
+                (numWavelengths, numTimepoints, NUM_HISTOGRAM_BINS), 
+                numpy.int64)
+        histogramRanges = numpy.zeros((numWavelengths, numTimepoints, 2))
+
+        for wavelength in xrange(numWavelengths):
+            for timepoint in xrange(numTimepoints):
+                starts = range(0, numZ, chunkSize)
+                for start in starts:
+                    end = min(numZ, start + chunkSize)
+                    block = self.imageArray[wavelength, timepoint, start:end]
+                    index = (wavelength, timepoint, slice(start, end))
+                    sectionStats['min'][index] = block.min(axis = (1, 2))
+                    sectionStats['max'][index] = block.max(axis = (1, 2))
+                    sectionStats['mean'][index] = block.mean(axis = (1, 2),
+                            dtype = numpy.float64)
+                    sectionStats['var'][index] = block.var(axis = (1, 2),
+                            dtype = numpy.float64)
+                # Now that we know the range of the volume, we can bin it. 
+                # It was just read, so this second pass should mostly hit 
+                # the page cache.
+                volumeRange = (sectionStats['min'][wavelength, timepoint].min(),
+                        sectionStats['max'][wavelength, timepoint].max())
+                for start in starts:
+                    end = min(numZ, start + chunkSize)
+                    block = self.imageArray[wavelength, timepoint, start:end]
+                    counts, edges = numpy.histogram(block, 
+                            NUM_HISTOGRAM_BINS, volumeRange)
+                    histograms[wavelength, timepoint] += counts
+                histogramRanges[wavelength, timepoint] = edges[0], edges[-1]
+        self.sectionStats = sectionStats
+        self.histograms = histograms
+        self.histogramRanges = histogramRanges
+        self.saveSidecar()
+
+        result = self.summarize(sectionStats)
+        with self.lock:
+            self.stats = result
+            self.isExact = True
+        return result
+
+
+    ## Combine per-section statistics into statistics for each wavelength.
+    # \param sectionStats Mapping as in self.sectionStats.
+    # \return The same mapping as self.estimate().
+    def summarize(self, sectionStats):
+        numWavelengths = sectionStats['mean'].shape[0]
+        result = dict([(name, []) for name in STAT_NAMES])
+        for wavelength in xrange(numWavelengths):
+            means = sectionStats['mean'][wavelength]
+            result['min'].append(sectionStats['min'][wavelength].min())
+            result['max'].append(sectionStats['max'][wavelength].max())
+            result['mean'].append(means.mean())
+            # All sections are the same size, so the total variance is the 
+            # mean within-section variance plus the variance of the means.
+            variance = sectionStats['var'][wavelength].mean() + means.var()
+            result['std'].append(numpy.sqrt(variance))
+        return result
+
+
+    ## Load exact statistics from the sidecar file, if there is one and it
+    # matches our data.
+    # \return True if the statistics were loaded.
+    def loadSidecar(self):
+        if self.sidecarPath is None or not os.path.exists(self.sidecarPath):
+            return False
+        numWavelengths, numTimepoints, numZ = self.imageArray.shape[:3]
+        try:
+            with open(self.sidecarPath, 'rb') as handle:
+                archive = numpy.load(handle)
+                if str(archive['key']) != self.sidecarKey:
+                    return False
+                sectionStats = dict([(name, archive[name]) 
+                        for name in SECTION_STAT_NAMES])
+                histograms = archive['histograms']
+                histogramRanges = archive['histogramRanges']
+        except Exception, e:
+            # A corrupt or unreadable sidecar is no worse than a missing one.
+            print "Couldn't load statistics from %s: %s" % (self.sidecarPath, e)
+            return False
+        for stats in sectionStats.values():
+            if stats.shape != (numWavelengths, numTimepoints, numZ):
+                return False
+        self.sectionStats = sectionStats
+        self.histograms = histograms
+        self.histogramRanges = histogramRanges
+        return True
+
+
+    ## Save our exact statistics to the sidecar file. Failure to do so (e.g.
+    # because the data is on read-only media) isn't a problem; we just have
+    # to compute them again next time.
+    def saveSidecar(self):
+        if self.sidecarPath is None:
+            return
+        arrays = dict(self.sectionStats)
+        arrays['histograms'] = self.histograms
+        arrays['histogramRanges'] = self.histogramRanges
+        arrays['key'] = numpy.array(self.sidecarKey)
+        # Write to a temporary file first so that nobody ever sees a 
+        # partially-written sidecar. Passing a file object stops numpy from
+        # adding a .npz extension.
+        tempPath = self.sidecarPath + '.tmp'
+        try:
+            with open(tempPath, 'wb') as handle:
+                numpy.savez(handle, **arrays)
+            replaceFile(tempPath, self.sidecarPath)
+        except (IOError, OSError), e:
+            print "Couldn't save statistics to %s: %s" % (self.sidecarPath, e)
+            if os.path.exists(tempPath):
+                try:
+                    os.remove(tempPath)
+                except OSError:
+                    pass
+
+
+    ## Start computing exact statistics in a background thread, unless we 
+    # already have them.
+    # \param callback Function to call, with this object as its argument,
+    #        once the exact statistics are available.
+    def refineInBackground(self, callback = None):
+        if self.isExact:
+            return
+        def refine():
+            self.computeExact()
+            if callback is not None:
+                callback(self)
+        self.refineThread = threading.Thread(target = refine)
+        self.refineThread.daemon = True
+        self.refineThread.start()
+
+
+    ## Block until any background refinement has finished.
+    def waitForExact(self):
+        if self.refineThread is not None:
+            self.refineThread.join()
+
+
+    ## Return the named statistic (one of STAT_NAMES) for every wavelength.
+    def get(self, name):
+        with self.lock:
+            return list(self.stats[name])
+
+
+    ## Return the mean of every wavelength.
+    def getMeans(self):
+        return self.get('mean')
+
+
+    ## Return the min and max of every wavelength in the given XY section, 
+    # or None if the exact statistics aren't available yet.
+    def getSectionRange(self, timepoint, z):
+        sectionStats = self.sectionStats
+        if sectionStats is None:
+            return None
+        return (sectionStats['min'][:, timepoint, z], 
+                sectionStats['max'][:, timepoint, z])
+
+
+    ## Return the min and max of the given (wavelength, timepoint) volume, 
+    # or None if the exact statistics aren't available yet.
+    def getVolumeRange(self, wavelength, timepoint):
+        sectionStats = self.sectionStats
+        if sectionStats is None:
+            return None
+        return (sectionStats['min'][wavelength, timepoint].min(), 
+                sectionStats['max'][wavelength, timepoint].max())
+
+
+    ## Return the histogram of the given (wavelength, timepoint) volume, as
+    # (bin counts, bin edges) like numpy.histogram, or None if the exact
+    # statistics aren't available yet.
+    def getHistogram(self, wavelength, timepoint):
+        if self.histograms is None:
+            return None
+        minVal, maxVal = self.histogramRanges[wavelength, timepoint]
+        edges = numpy.linspace(minVal, maxVal, NUM_HISTOGRAM_BINS + 1)
+        return self.histograms[wavelength, timepoint], edges
+
+
+
+## Generate a key identifying the current contents of the file at the given
+# path, for checking that a sidecar file is up to date: the file's size and
+# modification time, and a hash of its header.
+def makeSidecarKey(filePath, header):
+    fileInfo = os.stat(filePath)
+    return "%d:%r:%s" % (fileInfo.st_size, fileInfo.st_mtime, 
+            hashlib.md5(header).hexdigest())
+
+
+
+## Rename source to target, replacing target if it exists. os.rename does 
+# that on POSIX, but on Windows it fails if target exists, so there we 
+# remove target first.
+def replaceFile(source, target):
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
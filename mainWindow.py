@@ -41,6 +41,7 @@ import scipy.ndimage.filters
 import tifffile
 
 import editor
+import prefetch
 import viewerWindow
 import viewControlWindow
 import dialogs
@@ -152,7 +153,8 @@ class MainWindow(wx.Frame):
         if permission != wx.OK:
             return
                 
-        curPanel.dataDoc.alignAndCrop(savePath = targetPath)
+        if not self.saveDoc(curPanel.dataDoc, targetPath):
+            return
 
         doc_to_edit = datadoc.DataDoc(targetPath)
 
@@ -203,13 +205,28 @@ class MainWindow(wx.Frame):
                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
         if fd.ShowModal() == wx.ID_OK:
             targetPath = fd.GetPath()
-            curPanel.dataDoc.alignAndCrop(savePath = targetPath)
+            if not self.saveDoc(curPanel.dataDoc, targetPath):
+                return
             doc_to_edit = datadoc.DataDoc(targetPath)
             self.controlPanelsNotebook.AddPage(
                     ControlPanel(self, doc_to_edit),
                     os.path.basename(targetPath), select=True)
 
 
+    ## Align and crop the given DataDoc to the given path, returning True 
+    # on success. If it can't be saved there (e.g. because it's the open 
+    # file and the platform won't let us replace it), tell the user why 
+    # and return False.
+    def saveDoc(self, dataDoc, targetPath):
+        try:
+            dataDoc.alignAndCrop(savePath = targetPath)
+        except RuntimeError, e:
+            wx.MessageDialog(self, str(e), "Couldn't save file",
+                    wx.ICON_ERROR | wx.OK | wx.STAY_ON_TOP).ShowModal()
+            return False
+        return True
+
+
     ## This would be a decorator function if I could find a non-hacky way to 
     # do decorators of instance methods, but since I can't, it just pops up a
     # message dialog if the user hasn't opened a file yet, and otherwise
@@ -474,6 +491,10 @@ class ControlPanel(wx.Panel):
         # while already updating.
         self.displayUpdateLock = threading.Lock()
 
+        ## Computes slices ahead of time while the user moves through the 
+        # data.
+        self.prefetcher = prefetch.SlicePrefetcher()
+
         self.updateGLGraphics()
 
         wx.CallAfter(self.autoFitHistograms)
@@ -561,8 +582,10 @@ class ControlPanel(wx.Panel):
         #self.alignSwapButtons = []
 
         self.histograms = []
-        # For generating the histograms.
-        dataSlice = self.dataDoc.takeDefaultSlice((1, 2), False)
+        # For generating the histograms, if the data statistics don't 
+        # already have them.
+        dataSlice = None
+        timepoint = self.dataDoc.curViewIndex[1]
 
         for wavelength in range(self.dataDoc.numWavelengths):
             # Create the panels containing the alignment parameters for each
@@ -594,10 +617,17 @@ class ControlPanel(wx.Panel):
 
             color = util.waveToRGB(self.dataDoc.channelWaves[wavelength])
             self.colors[wavelength] = color
+            volumeHistogram = self.dataDoc.stats.getHistogram(wavelength,
+                    timepoint)
+            image = None
+            if volumeHistogram is None:
+                if dataSlice is None:
+                    dataSlice = self.dataDoc.takeDefaultSlice((1, 2), False)
+                image = dataSlice[wavelength]
             newHistogram = histogram.HistogramPanel(panel, 
                     self.changeHistScale, self.setHelpText, 
-                    wavelength, dataSlice[wavelength], color, 
-                    size = (176, 40)
+                    wavelength, image, color, 
+                    size = (176, 40), histogram = volumeHistogram
             )
             self.histograms.append(newHistogram)
             columnSizer.Add(newHistogram)
@@ -729,12 +759,21 @@ class ControlPanel(wx.Panel):
             histogram.autoFit()
 
 
-    ## Rescale the histograms to fit just the current XY view.
+    ## Rescale the histograms to fit just the current XY view. If the data
+    # statistics are available, we use the min/max of the (untransformed) 
+    # section rather than scanning the slice.
     def autoFitHistogramsXY(self, event = None):
-        targetCoords = self.dataDoc.getSliceCoords((1, 2))
-        image = self.dataDoc.takeSlice(targetCoords)
-        for wavelength, histogram in enumerate(self.histograms):
-            histogram.autoFitToImage(image[wavelength])
+        timepoint, z = self.dataDoc.curViewIndex[1:3]
+        sectionRange = self.dataDoc.stats.getSectionRange(timepoint, z)
+        if sectionRange is not None:
+            for wavelength, histogram in enumerate(self.histograms):
+                histogram.autoFitToRange(sectionRange[0][wavelength], 
+                        sectionRange[1][wavelength])
+        else:
+            targetCoords = self.dataDoc.getSliceCoords((1, 2))
+            image = self.dataDoc.takeSlice(targetCoords)
+            for wavelength, histogram in enumerate(self.histograms):
+                histogram.autoFitToImage(image[wavelength])
         wx.CallAfter(self.setViewerScalings)
 
 
@@ -778,6 +817,7 @@ class ControlPanel(wx.Panel):
 
     ## Close our alignment progress window, if any.
     def OnClose(self, event = None):
+        self.prefetcher.clear()
         if self.alignProgressWindow is not None:
             self.alignProgressWindow.Destroy()
             self.alignProgressWindow = None
@@ -850,8 +890,14 @@ class ControlPanel(wx.Panel):
     # min/max are set to 0/1.
     def getFilteredData(self, wavelength, perpendicularAxes = (1, 2)):
         targetCoords = self.dataDoc.getSliceCoords(perpendicularAxes)
-        baseData = self.dataDoc.takeSlice(targetCoords).astype(numpy.float)[wavelength]
-        
+        return self.filterSlice(wavelength,
+                self.dataDoc.takeSlice(targetCoords)[wavelength])
+
+
+    ## Filter data from the given wavelength as getFilteredData does, 
+    # returning a new array.
+    def filterSlice(self, wavelength, data):
+        baseData = data.astype(numpy.float)
         dataMin = baseData.min()
         dataMax = baseData.max()
         histogram = self.histograms[wavelength]
@@ -916,12 +962,17 @@ class ControlPanel(wx.Panel):
 
     ## Retrieve the 3D array for the specified wavelength, in addition to 
     # our reference wavelength, and pass them back to the worker.
+    # \param params Alignment parameters to align the wavelength with, in 
+    #        place of its current ones.
     @util.callInMainThread
-    def getFullVolume(self, wavelength, worker):
+    def getFullVolume(self, wavelength, worker, params):
         reference = self.getReferenceWavelength()
+        alignParams = self.dataDoc.alignParams.copy()
+        alignParams[wavelength] = params
         result = self.dataDoc.alignAndCrop(
                 wavelengths = [reference, wavelength], 
-                timepoints = [self.dataDoc.curViewIndex[1]])
+                timepoints = [self.dataDoc.curViewIndex[1]],
+                alignParams = alignParams)
         # Take the first timepoint.
         worker.setVolumes(result[0][0], result[1][0])
 
@@ -1104,19 +1155,7 @@ class ControlPanel(wx.Panel):
     # DataDoc has to do expensive transformations to retrieve the relevant
     # data.
     def updateViewerDisplay(self, viewer):
-        # axes_set is the set of all axes that we use -- X, Y, Z, and time.
-        axes_set = set((4, 3, 2, 1))
-        axesNormal = list(axes_set.difference(set(viewer.axes)))
-        targetCoords = self.dataDoc.getSliceCoords(axesNormal)
-        # We can save processing power if we offload transformations to 
-        # OpenGL whenever feasible. That basically is limited to the XY
-        # slice when there's no Z translation, or the YZ/XZ slices when 
-        # there's no transformation at all.
-        shouldTransform = False
-        if viewer.axes == (4, 3) and self.dataDoc.hasZMotion():
-            shouldTransform = True
-        elif viewer.axes != (4, 3) and self.dataDoc.hasTransformation():
-            shouldTransform = True
+        shouldTransform = self.getShouldTransform(viewer)
             
         # Only do this if we've generated a full list of images already.
         if not shouldTransform and len(viewer.imgList) == self.dataDoc.numWavelengths:
@@ -1127,19 +1166,21 @@ class ControlPanel(wx.Panel):
                 # viewer transformations to the XY slice.
                 viewer.changeImgOffset(wavelength, dx, dy, angle, zoom, False)
 
-        # If necessary, take a projected slice.
-        imageSlice = None
-        if (viewer.axes in self.axesToProjectionMap and 
-                self.axesToProjectionMap[viewer.axes]):
-            imageSlice = self.dataDoc.takeProjectedSlice(targetCoords, self.axesToProjectionMap[viewer.axes], shouldTransform)
-        else:
-            imageSlice = self.dataDoc.takeSlice(targetCoords, shouldTransform)
+        # Use the prefetched slice, if there is one.
+        key, function, args, scale = self.getSliceRequest(viewer, 
+                self.dataDoc.curViewIndex)
+        imageSlice = self.prefetcher.get(key, function, *args)
             
         # HACK: For now, transpose the YZ view so Y is vertical. Later we
         # want to make this a property of the viewer
         if viewer.axes == (2, 3):
             imageSlice = imageSlice.transpose(0, 2, 1)
-        viewer.addImgL(imageSlice)
+        dataShape = None
+        if scale != 1:
+            # Only XY slices are downsampled; their padding can cover a 
+            # little more than the data does.
+            dataShape = self.dataDoc.size[3:]
+        viewer.addImgL(imageSlice, scale = scale, dataShape = dataShape)
         
         if shouldTransform:
             # OpenGL transforms should not be used since the slice already
@@ -1151,6 +1192,68 @@ class ControlPanel(wx.Panel):
             viewer.setColor(i, self.colors[i])
 
 
+    ## Return whether or not the given viewer needs the DataDoc to 
+    # transform its slices. We can save processing power if we offload 
+    # transformations to OpenGL whenever feasible. That basically is limited
+    # to the XY slice when there's no Z translation, or the YZ/XZ slices 
+    # when there's no transformation at all.
+    def getShouldTransform(self, viewer):
+        if viewer.axes == (4, 3):
+            return self.dataDoc.hasZMotion()
+        return self.dataDoc.hasTransformation()
+
+
+    ## Show how far through a projection through time the DataDoc is in the
+    # status bar of our parent MainWindow. Projections may be generated by 
+    # the prefetcher's worker threads, which mustn't touch the UI directly.
+    # \param done Number of timepoints projected so far.
+    # \param total Total number of timepoints to project.
+    def onProjectionProgress(self, done, total):
+        text = ''
+        if done < total:
+            text = "Projecting through time: %d/%d timepoints" % (done, total)
+        if wx.Thread_IsMain():
+            self.parent.SetStatusText(text, 0)
+            self.parent.statbar.Update()
+        else:
+            wx.CallAfter(self.parent.SetStatusText, text, 0)
+
+
+    ## Work out how to generate the images the given viewer should show when 
+    # the view is at the given position.
+    # \param viewIndex WTZYX position, like DataDoc.curViewIndex.
+    # \return A key identifying the images, a function and arguments that 
+    #         generate them, and the size of their pixels in data pixels.
+    def getSliceRequest(self, viewer, viewIndex):
+        # axes_set is the set of all axes that we use -- X, Y, Z, and time.
+        axes_set = set((4, 3, 2, 1))
+        axesNormal = list(axes_set.difference(set(viewer.axes)))
+        targetCoords = dict([(axis, viewIndex[axis]) for axis in axesNormal])
+        shouldTransform = self.getShouldTransform(viewer)
+        position = tuple(sorted(targetCoords.items()))
+        # Slices depend on the alignment parameters, so they're part of 
+        # the key.
+        alignKey = self.dataDoc.alignParams.tostring()
+
+        projectionAxis = self.axesToProjectionMap.get(viewer.axes)
+        if projectionAxis:
+            key = ('projection', position, projectionAxis, shouldTransform, 
+                    alignKey)
+            return (key, self.dataDoc.takeProjectedSlice, 
+                    (targetCoords, projectionAxis, shouldTransform, 1,
+                     self.onProjectionProgress), 1)
+        level = viewer.getPyramidLevel()
+        if not shouldTransform and level:
+            # The viewer is too small to show every pixel, so use a 
+            # downsampled slice instead.
+            key = ('downsampled', position, level)
+            return (key, self.dataDoc.takeDownsampledSlice,
+                    (targetCoords[1], targetCoords[2], level), 2 ** level)
+        key = ('slice', position, shouldTransform, alignKey)
+        return (key, self.dataDoc.takeSlice, 
+                (targetCoords, shouldTransform), 1)
+
+
     def getIsViewCropped(self):
         return self.isViewCropped
 
@@ -1250,10 +1353,31 @@ class ControlPanel(wx.Panel):
                     updatedViews.append(viewer)
         # Inform our ViewsWindow about the new sliceline locations.
         self.viewControlWindow.setSliders(self.dataDoc.getSliceCoords())
+        self.prefetchSlices(offset, updatedViews)
         wx.CallAfter(self.updateGLGraphics, updatedViews)
         wx.CallAfter(self.setViewerScalings)
 
 
+    ## Guess that the view will keep moving by the given offset, and start
+    # computing the slices the given viewers will need, nearest first. 
+    # Projections aren't prefetched: a projection through time transforms
+    # every volume, which can't be called off once started, and the other 
+    # projections are cached per timepoint by the DataDoc, which fills in 
+    # untransformed ones in the background itself.
+    def prefetchSlices(self, offset, viewers):
+        viewers = [viewer for viewer in viewers 
+                if not self.axesToProjectionMap.get(viewer.axes)]
+        requests = []
+        position = numpy.array(self.dataDoc.curViewIndex)
+        for step in xrange(prefetch.PREFETCH_DEPTH):
+            position = position + offset
+            if numpy.any(position < 0) or numpy.any(position >= self.dataDoc.size):
+                break
+            for viewer in viewers:
+                requests.append(self.getSliceRequest(viewer, position)[:3])
+        self.prefetcher.prefetch(requests)
+
+
     ## As moveSliceLines, but instead of adding an offset, sets a specific
     # axis to a certain value.
     def setSliceLine(self, axis, target):
@@ -0,0 +1,119 @@
+# Copyright 2015, Graeme Ball
+# Copyright 2012, The Regents of University of California
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import Queue
+import threading
+import traceback
+
+## Number of steps ahead of the current view position to prefetch slices 
+# for.
+PREFETCH_DEPTH = 3
+
+## Number of worker threads computing slices.
+NUM_WORKERS = 2
+
+
+## This class computes slices of data ahead of time on worker threads, so 
+# that they are ready by the time the user navigates to them. The functions
+# that generate slices are expected to cache their results (as 
+# DataDoc.takeSlice does), so calling them again once a worker has run 
+# them is cheap. Slices are identified by keys, which must capture 
+# everything the result depends on (e.g. position, projection mode, and 
+# alignment parameters).
+class SlicePrefetcher:
+    ## \param numWorkers Number of worker threads to start.
+    def __init__(self, numWorkers = NUM_WORKERS):
+        ## Maps keys of slices that workers are currently computing to 
+        # Events that are set when they are done.
+        self.inProgress = {}
+        ## Lock around self.inProgress and self.generation.
+        self.lock = threading.Lock()
+        ## Incremented every time a new set of slices is requested, so that 
+        # workers can skip requests that are no longer relevant.
+        self.generation = 0
+        ## Queue of (generation, key, function, args) tuples for the workers.
+        self.jobs = Queue.Queue()
+        for i in xrange(numWorkers):
+            thread = threading.Thread(target = self.work)
+            thread.daemon = True
+            thread.start()
+
+
+    ## Return the slice for the given key by calling function(*args). If a
+    # worker is already computing it, wait for the worker first instead of 
+    # duplicating its effort.
+    def get(self, key, function, *args):
+        with self.lock:
+            event = self.inProgress.get(key)
+        if event is not None:
+            event.wait()
+        return function(*args)
+
+
+    ## Replace any outstanding requests with a new list of 
+    # (key, function, args) tuples, in order of priority.
+    def prefetch(self, requests):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        # Drop requests that haven't been started yet.
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except Queue.Empty:
+                break
+        for key, function, args in requests:
+            self.jobs.put((generation, key, function, args))
+
+
+    ## Discard all outstanding requests.
+    def clear(self):
+        self.prefetch([])
+
+
+    ## Worker thread main loop: compute requested slices, discarding the 
+    # results, which the generating functions will have cached.
+    def work(self):
+        while True:
+            generation, key, function, args = self.jobs.get()
+            with self.lock:
+                if generation != self.generation or key in self.inProgress:
+                    continue
+                event = threading.Event()
+                self.inProgress[key] = event
+            try:
+                function(*args)
+            except Exception, e:
+                print "Failed to prefetch slice %s: %s" % (key, e)
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    del self.inProgress[key]
+                event.set()
@@ -0,0 +1,122 @@
+# Copyright 2015, Graeme Ball
+# Copyright 2012, The Regents of University of California
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import numpy
+import threading
+from collections import OrderedDict
+
+## Maximum number of bytes of downsampled images to keep around.
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+## Return the largest pyramid level that still has at least one pixel in 
+# each dimension, for XY sections of the given (Y, X) size.
+def getMaxLevel(shape):
+    level = 0
+    while min(shape) >> (level + 1) >= 1:
+        level += 1
+    return level
+
+
+## Return a copy of the 2D image, downsampled by a factor of 2 in each 
+# dimension by averaging 2x2 blocks of pixels. Any odd row/column at the 
+# end is padded by repeating it, so nothing is dropped and pixel i of the 
+# result always covers pixels 2i and 2i + 1 of the image. The result has 
+# the same datatype as the input.
+def downsample(image):
+    numY, numX = image.shape
+    if numY % 2 or numX % 2:
+        image = numpy.pad(image, ((0, numY % 2), (0, numX % 2)), 
+                mode = 'edge')
+    blocks = numpy.asarray(image, 
+            dtype = numpy.promote_types(image.dtype, numpy.float32))
+    result = (blocks[0::2, 0::2] + blocks[1::2, 0::2] + 
+            blocks[0::2, 1::2] + blocks[1::2, 1::2]) / 4
+    if numpy.issubdtype(image.dtype, numpy.integer):
+        numpy.rint(result, result)
+    return result.astype(image.dtype)
+
+
+## This class provides downsampled versions of the XY sections of a 5D 
+# WTZYX array: level N of the pyramid for a given section is the section
+# block-averaged down by a factor of 2 ** N in X and Y. Levels are only 
+# generated when they are asked for, each from the level below it, and are 
+# kept in a least-recently-used cache of bounded size.
+class PyramidCache:
+    ## \param imageArray 5D array of pixel data, in WTZYX order.
+    # \param maxBytes Maximum number of bytes of images to cache.
+    def __init__(self, imageArray, maxBytes = MAX_CACHE_BYTES):
+        self.imageArray = imageArray
+        self.maxBytes = maxBytes
+        ## Maps (wavelength, timepoint, z, level) to downsampled images, in
+        # order of least to most recently used.
+        self.cache = OrderedDict()
+        ## Number of bytes of images currently in self.cache.
+        self.numBytes = 0
+        ## Lock around self.cache and self.numBytes.
+        self.lock = threading.Lock()
+
+
+    ## Return the XY section at the given wavelength, timepoint, and Z 
+    # index, downsampled to the given level. Level 0 is the section itself.
+    def getLevel(self, wavelength, timepoint, z, level):
+        if level == 0:
+            return self.imageArray[wavelength, timepoint, z]
+        key = (wavelength, timepoint, z, level)
+        with self.lock:
+            if key in self.cache:
+                image = self.cache.pop(key)
+                self.cache[key] = image
+                return image
+        image = downsample(self.getLevel(wavelength, timepoint, z, level - 1))
+        self.add(key, image)
+        return image
+
+
+    ## Add an image to the cache, evicting the least recently used images 
+    # as needed to stay under our size limit.
+    def add(self, key, image):
+        if image.nbytes > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.cache:
+                self.numBytes -= self.cache.pop(key).nbytes
+            while self.cache and self.numBytes + image.nbytes > self.maxBytes:
+                oldKey, oldImage = self.cache.popitem(last = False)
+                self.numBytes -= oldImage.nbytes
+            self.cache[key] = image
+            self.numBytes += image.nbytes
+
+
+    ## Discard all cached images.
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.numBytes = 0
@@ -0,0 +1,187 @@
+# Copyright 2015, Graeme Ball
+# Copyright 2012, The Regents of University of California
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import numpy
+import threading
+
+
+## This class holds everything needed to take transformed 2D slices of a 
+# given geometry (i.e. a given data shape and pair of axes the slices cut 
+# across) that doesn't depend on where the slice is, so that it can be 
+# reused from one slice to the next. 
+# The coordinates to look up for a slice are an affine function of the 
+# coordinates of the slice's pixels. Those form a regular grid, so instead 
+# of storing the whole grid we store the coordinates along each of its two 
+# dimensions (as float32, which holds them exactly), and generate the lookup
+# coordinates from them into a buffer that is allocated once per plan. The
+# buffer is float64: float32 lookup coordinates shift interpolated values 
+# enough to change pixel values once they're truncated to integers.
+class SlicePlan:
+    ## \param shape Shape of the 5D WTZYX data slices will be taken from.
+    # \param targetAxes The two non-wavelength axes slices cut across, in 
+    #        increasing order; e.g. (3, 4) for XY slices.
+    def __init__(self, shape, targetAxes):
+        self.shape = tuple(shape)
+        self.targetAxes = tuple(targetAxes)
+        ## Shape of a slice in a single wavelength.
+        self.sliceShape = tuple([self.shape[axis] for axis in targetAxes])
+        ## XYZ center of the data, about which transformations are done.
+        self.center = numpy.array(self.shape[2:][::-1]) / 2.0
+        ## Whether the slices cut across time.
+        self.isTimeCut = 1 in targetAxes
+        ## For each of X, Y, and Z, the coordinates relative to the center 
+        # along the slice, shaped to broadcast across the slice's grid; or 
+        # None if the slice doesn't vary in that axis.
+        self.bases = []
+        for i, axis in enumerate([4, 3, 2]):
+            basis = None
+            if axis in targetAxes:
+                basis = numpy.arange(self.shape[axis], 
+                        dtype = numpy.float32) - self.center[i]
+                if targetAxes.index(axis) == 0:
+                    basis.shape = -1, 1
+                else:
+                    basis.shape = 1, -1
+            self.bases.append(basis)
+        ## Number of coordinate rows: (T)ZYX.
+        self.numRows = 3
+        if self.isTimeCut:
+            self.numRows = 4
+        ## Buffer holding the coordinates to look up in a single wavelength,
+        # in (T)ZYX order; allocated when first needed.
+        self.coords = None
+        ## Buffer holding the coordinates to look up in all wavelengths at 
+        # once, in W(T)ZYX order, with an extra axis for the wavelength; 
+        # allocated when first needed.
+        self.batchCoords = None
+        ## Buffer for the values looked up using self.batchCoords.
+        self.batchOutput = None
+        ## Lock around our buffers, which callers need to hold for as long
+        # as they use the results of self.getCoords/self.getBatchCoords.
+        self.lock = threading.Lock()
+
+
+    ## Return the number of bytes of buffers needed to sample all 
+    # wavelengths at once with self.getBatchCoords.
+    def getBatchBytes(self):
+        numPixels = self.shape[0] * numpy.product(self.sliceShape)
+        return (self.numRows + 2) * numPixels * numpy.dtype(numpy.float64).itemsize
+
+
+    ## Fill in and return a buffer with the coordinates to look up in the
+    # data to generate a transformed slice through one wavelength.
+    # \param inverseTransform Inverse of the 4x4 transformation matrix for 
+    #        the wavelength, as from DataDoc.getTransformationMatrices.
+    # \param axes Maps axes to the positions the slice passes through, as 
+    #        for DataDoc.takeSlice.
+    def getCoords(self, inverseTransform, axes):
+        if self.coords is None:
+            self.coords = self.makeCoordsBuffer((self.numRows,) + self.sliceShape)
+        self.fillCoords(self.coords, inverseTransform, axes)
+        return self.coords
+
+
+    ## As getCoords, but for several wavelengths at once: the result has an 
+    # extra leading row holding the index of each wavelength relative to 
+    # the first one, and the coordinates for the i'th wavelength in [:, i].
+    # \param inverseTransforms List of inverse transformation matrices, one
+    #        per wavelength in the data.
+    # \param wavelengths Increasing list of the wavelengths to sample.
+    def getBatchCoords(self, inverseTransforms, axes, wavelengths):
+        if self.batchCoords is None:
+            numWavelengths = self.shape[0]
+            shape = (self.numRows + 1, numWavelengths) + self.sliceShape
+            self.batchCoords = numpy.empty(shape, numpy.float64)
+            self.batchCoords[1:] = self.makeCoordsBuffer(
+                    (self.numRows,) + self.sliceShape)[:, None]
+            self.batchOutput = numpy.empty(
+                    (numWavelengths,) + self.sliceShape, numpy.float64)
+        for i, wavelength in enumerate(wavelengths):
+            self.batchCoords[0, i] = wavelength - wavelengths[0]
+            self.fillCoords(self.batchCoords[1:, i], 
+                    inverseTransforms[wavelength], axes)
+        return self.batchCoords[:, :len(wavelengths)]
+
+
+    ## Make a buffer of the given shape for coordinates, filling in the 
+    # time coordinates, if any, which never change.
+    def makeCoordsBuffer(self, shape):
+        coords = numpy.empty(shape, numpy.float64)
+        if self.isTimeCut:
+            coords[0] = numpy.arange(self.shape[1]).reshape(-1, 1)
+        return coords
+
+
+    ## Fill in the ZYX coordinates (the last three rows) of the given 
+    # buffer; see getCoords.
+    def fillCoords(self, coords, inverseTransform, axes):
+        # Position of the slice, relative to the center, in the axes it 
+        # doesn't vary in.
+        offset = numpy.zeros(3)
+        for i, axis in enumerate([4, 3, 2]):
+            if self.bases[i] is None:
+                offset[i] = axes[axis] - self.center[i]
+        shift = (numpy.dot(inverseTransform[:3, :3], offset) + 
+                inverseTransform[:3, 3] + self.center)
+        # First row of coords holding the Z coordinate.
+        firstRow = len(coords) - 3
+        for i in xrange(3):
+            row = coords[firstRow + 2 - i]
+            row.fill(shift[i])
+            for j, basis in enumerate(self.bases):
+                if basis is not None and inverseTransform[i, j]:
+                    row += numpy.multiply(basis, inverseTransform[i, j], 
+                            dtype = numpy.float64)
+
+
+    ## Work out the block of the ZYX volume that the given coordinates (as 
+    # from getCoords or getBatchCoords) look up into, so that only that 
+    # block needs to be read and interpolated, and make the coordinates 
+    # relative to the block. Coordinates outside the volume stay outside 
+    # the block.
+    # \param shape ZYX shape of the volume.
+    # \param margin Number of extra pixels to include around the block on 
+    #        each side, for interpolation that looks further afield.
+    # \return A tuple of ZYX slices of the block, or None if every 
+    #         coordinate is outside the volume.
+    def cropCoords(self, coords, shape, margin = 0):
+        block = []
+        # First row of coords holding the Z coordinate.
+        firstRow = len(coords) - 3
+        for i, size in enumerate(shape):
+            row = coords[firstRow + i]
+            low = max(0, int(numpy.floor(row.min())) - margin)
+            high = min(size, int(numpy.ceil(row.max())) + margin + 1)
+            if low >= high:
+                return None
+            if low:
+                row -= low
+            block.append(slice(low, high))
+        return tuple(block)
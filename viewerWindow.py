@@ -30,6 +30,7 @@
 
 import numpy
 import datadoc
+import pyramid
 from OpenGL.GL import *
 import OpenGL.GL as GL
 import wx
@@ -160,29 +161,39 @@ class GLViewer(wx.glcanvas.GLCanvas):
         self.haveInitedGL = True
 
 
-    def addImgL(self, imgL, smin=0, smax=0, refreshNow=1):
+    def addImgL(self, imgL, smin=0, smax=0, refreshNow=1, scale=1,
+                dataShape=None):
         '''
         append images from a list of them
+        scale: size of an image pixel in data pixels (for downsampled images)
+        dataShape: YX size of the images in data pixels (for downsampled 
+            images, whose padding makes them cover a little more)
         '''
         for i, img in enumerate(imgL):
-            self.addImg(i, img, smin, smax)
+            self.addImg(i, img, smin, smax, scale, dataShape)
         if refreshNow:
             self.Refresh(0)
 
 
     ## Update image data, or create a new Image instance if we don't have one
     # in the indicated slot already.
-    def addImg(self, index, img, smin=0, smax=10000):
-        pic_ny, pic_nx = img.shape
+    # \param scale Size of an image pixel in data pixels, for images that
+    #        have been downsampled.
+    # \param dataShape YX size of the image in data pixels; by default, its
+    #        shape times scale.
+    def addImg(self, index, img, smin=0, smax=10000, scale=1, dataShape=None):
+        if dataShape is None:
+            dataShape = (img.shape[0] * scale, img.shape[1] * scale)
 
-        self.pic_ny, self.pic_nx = pic_ny,pic_nx
+        self.pic_ny, self.pic_nx = dataShape
 
         self.SetCurrent(self.context)
         if len(self.imgList) <= index:
-            newImage = Image(img, smin, smax)
+            newImage = Image(img, smin, smax, scale, dataShape)
             self.imgList.append(newImage)
         else:
-            self.imgList[index].updateImage(img, smin, smax)
+            self.imgList[index].updateImage(img, smin, smax, scale, 
+                    dataShape)
 
 
     def changeHistScale(self, imgidx, smin,smax, RefreshNow=1):
@@ -273,7 +284,7 @@ class GLViewer(wx.glcanvas.GLCanvas):
             if image.isVisible:
                 imageData = image.imageData
                 tx, ty, rot, mag = image.dx, image.dy, image.angle, image.zoom
-                cx,cy = imageData.shape[-1]/2., imageData.shape[-2]/2.
+                cy, cx = numpy.array(image.dataShape) / 2.
                 glPushMatrix()
                 # Move so we rotate about the center.
                 glTranslated(cx,cy, 0)
@@ -505,14 +516,30 @@ class GLViewer(wx.glcanvas.GLCanvas):
         self.Refresh(False)
 
 
-    ## Update the size of the canvas by scaling it.
+    ## Update the size of the canvas by scaling it. If that changes the 
+    # level of downsampling we should use, get new images from the 
+    # controller.
     def setSize(self, size, dataSize):
+        oldLevel = self.getPyramidLevel()
         self.scaleX = size[0] / float(dataSize[0])
         self.scaleY = size[1] / float(dataSize[1])
         self.w, self.h = size
+        if self.imgList and self.getPyramidLevel() != oldLevel:
+            self.viewManager.updateGLGraphics([self])
         self.Refresh(0)
 
 
+    ## Return the level of the DataDoc's pyramid of downsampled XY sections
+    # that best suits our current scale: the coarsest one that still has
+    # at least one pixel per screen pixel. Only the XY view is downsampled.
+    def getPyramidLevel(self):
+        scale = max(self.scaleX, self.scaleY)
+        if self.axes != (4, 3) or scale >= 1:
+            return 0
+        level = int(numpy.floor(numpy.log2(1 / scale)))
+        return min(level, pyramid.getMaxLevel(self.dataDoc.size[3:]))
+
+
     ## Pass keyboard events through to the controller.
     def OnKey(self, event):
         self.viewManager.onKey(event.GetKeyCode())
@@ -543,10 +570,18 @@ dtypeToMaxValMap = {
 
 ## This class handles display of a single 2D array of pixel data.
 class Image:
-    def __init__(self, imageData, imageMin, imageMax):
+    ## \param scale Size of a pixel of imageData in data pixels; greater 
+    #        than 1 if imageData has been downsampled.
+    # \param dataShape YX size of imageData in data pixels. Downsampled 
+    #        data is padded to a whole number of pixels, so it can cover a
+    #        little more than this; by default, its shape times scale.
+    def __init__(self, imageData, imageMin, imageMax, scale = 1, 
+            dataShape = None):
         self.imageData = imageData
         self.imageMin = imageMin
         self.imageMax = imageMax
+        self.scale = scale
+        self.dataShape = self.getDataShape(dataShape)
         self.dx = 0
         self.dy = 0
         self.angle = 0
@@ -626,8 +661,17 @@ class Image:
                 GL.GL_LUMINANCE, dtypeToGlTypeMap[imgType], imgString)
 
 
+    ## Return the given YX size in data pixels, or our default for it if 
+    # it's None; see __init__.
+    def getDataShape(self, dataShape):
+        if dataShape is None:
+            pic_ny, pic_nx = self.imageData.shape
+            return (pic_ny * self.scale, pic_nx * self.scale)
+        return tuple(dataShape)
+
+
     def render(self, scaleAxes):
-        cx,cy = self.imageData.shape[-1]/2., self.imageData.shape[-2]/2.
+        cy, cx = numpy.array(self.dataShape) / 2.
         GL.glPushMatrix()
 
         # To rotate about the center, first we have to move to it.
@@ -647,19 +691,26 @@ class Image:
 
         GL.glBegin(GL.GL_QUADS)
        
-        pic_ny, pic_nx = self.imageData.shape
+        # Draw the quad at full-resolution size, however many pixels the 
+        # texture has, leaving out any padding that downsampled data covers
+        # beyond the edge of the full-resolution data.
+        pic_ny, pic_nx = self.dataShape
+        texRatio_x = (self.picTexRatio_x * pic_nx / 
+                float(self.imageData.shape[1] * self.scale))
+        texRatio_y = (self.picTexRatio_y * pic_ny / 
+                float(self.imageData.shape[0] * self.scale))
 
         ###//(0,0) at left bottom
         GL.glTexCoord2f(0, 0)
         GL.glVertex2i(0, 0)
             
-        GL.glTexCoord2f(self.picTexRatio_x, 0)
+        GL.glTexCoord2f(texRatio_x, 0)
         GL.glVertex2i(pic_nx, 0)
             
-        GL.glTexCoord2f(self.picTexRatio_x, self.picTexRatio_y)
+        GL.glTexCoord2f(texRatio_x, texRatio_y)
         GL.glVertex2i(pic_nx, pic_ny)
             
-        GL.glTexCoord2f(0, self.picTexRatio_y)
+        GL.glTexCoord2f(0, texRatio_y)
         GL.glVertex2i(0, pic_ny)
 
         GL.glEnd()
@@ -672,10 +723,13 @@ class Image:
    
 
     ## Accept a new array of image data.
-    def updateImage(self, imageData, imageMin, imageMax):
+    def updateImage(self, imageData, imageMin, imageMax, scale = 1, 
+            dataShape = None):
         self.imageData = imageData
         self.imageMin = imageMin
         self.imageMax = imageMax
+        self.scale = scale
+        self.dataShape = self.getDataShape(dataShape)
 
         self.wipe()
         self.bindTexture()